@@ -0,0 +1,79 @@
+# Microbenchmark for parsing TFT commands in LCD.handle_command.
+#
+# Compares the per-command cost of the former regex/inspect based parsing
+# with the precompiled dispatch table. Only parsing is measured, handlers
+# are not called and the serial port is not opened.
+#
+#   python3 benchmarks/bench_dispatch.py [iterations]
+
+import inspect
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lcd import LCD
+
+COMMANDS = [
+    b'A0', b'A1', b'A2', b'A3', b'A4', b'A5', b'A6', b'A7',
+    b'A8 S4', b'A13 <1-d.idx>', b'A16 S240', b'A20', b'A20 S100',
+    b'A21 C', b'A22 X +10F3000',
+]
+
+
+def legacy_parse(lcd, data):
+    # Parsing as done by handle_command before the dispatch table
+    decoded_data = data.decode('utf-8')
+    match = re.match(r'A\d+', decoded_data)
+    if not match:
+        return None
+    addr = match.group(0)
+    if addr not in lcd.addr_func_map:
+        return None
+    func = lcd.addr_func_map[addr][0]
+    params = inspect.signature(func).parameters
+    s_param = re.search(r'S(\d+)', decoded_data)
+    c_param = re.search(r'C(\d+)', decoded_data)
+    altname_param = re.search(r'<[^>]+>', decoded_data)
+    moveAxismatch = re.match(r'A22\s+([XYZ])\s*([+-]?\d+(?:\.\d+)?)\s*F(\d+)', decoded_data)
+    plain_param_match = re.search(r'([a-zA-Z0-9_./-]+)', decoded_data.split(addr)[-1].strip())
+    plain_param = plain_param_match.group(1) if plain_param_match else None
+    if len(params) == 0:
+        return func, ()
+    elif s_param:
+        return func, (int(s_param.group(1)),)
+    elif c_param:
+        return func, (c_param.group(1),)
+    elif moveAxismatch:
+        return func, (moveAxismatch.group(1), moveAxismatch.group(2), moveAxismatch.group(3))
+    elif altname_param:
+        return func, (altname_param.group(),)
+    elif plain_param:
+        return func, (plain_param,)
+    return func, ()
+
+
+def bench(fn, data, number):
+    return min(timeit.repeat(lambda: fn(data), number=number, repeat=5)) / number * 1e9
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    lcd = LCD(None)
+
+    print("%-18s %12s %12s %8s" % ("command", "before [ns]", "after [ns]", "speedup"))
+    total_before = total_after = 0.0
+    for data in COMMANDS:
+        before = bench(lambda d: legacy_parse(lcd, d), data, number)
+        after = bench(lcd.parse_command, data, number)
+        total_before += before
+        total_after += after
+        print("%-18s %12.0f %12.0f %7.1fx" % (data.decode(), before, after, before / after))
+    print("%-18s %12.0f %12.0f %7.1fx" % ("mean", total_before / len(COMMANDS),
+                                          total_after / len(COMMANDS), total_before / total_after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+# End-to-end latency of the bridge, from a TFT command to its reply.
+#
+# Runs KlipperLCD against a pseudo-terminal standing in for the TFT and
+# the FakeMoonraker / FakeKlippy from fakes.py, served from a child
+# process, so no printer or display is needed. The commands are the
+# examples from sequence_diagrams/sequencediagrams.txt, grouped into
+# scenarios.
+#
+# Each command is written followed by an A1 poll. The bridge handles TFT
+# commands one after another, so the A1V reply marks the moment the
+# command was fully handled, whether or not it answers itself. A second
+# pass writes the status polls back to back to measure throughput.
+#
+# A33 is left out, its handler reads a field _printerData does not have.
+#
+#   python3 benchmarks/bench_e2e.py [rounds] [--asyncio]
+#
+# --asyncio runs the bridge on the event loop runtime (runtime.py).
+#
+# Exits non-zero when a command gets no reply within REPLY_TIMEOUT.
+
+import contextlib
+import os
+import pty
+import queue
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tty
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+
+REPLY_TIMEOUT = 5.0
+SYNC = b'A1'
+SYNC_REPLY = b'A1V'
+DIAGRAMS = os.path.join(HERE, '..', 'sequence_diagrams', 'sequencediagrams.txt')
+
+# A bare address plays every example of it found in the diagrams, explicit
+# arguments are used where the example does not match the fake listing
+SCENARIOS = [
+    ('status polls', ['A0', 'A1', 'A2', 'A3', 'A4', 'A5', 'A6', 'A7', 'A20']),
+    ('file browser', ['A8', 'A13', 'A13 <back-d.idx>', 'A26', 'A8 S4']),
+    ('controls', ['A16', 'A17', 'A18', 'A21', 'A22', 'A23', 'A24', 'A25', 'A19']),
+    ('print job', ['A8', 'A13 <0-f.idx>', 'A14', 'A9', 'A10', 'A11', 'A12', 'A15']),
+]
+
+
+def diagram_commands(path=DIAGRAMS):
+    # addr -> example commands the TFT sends, in diagram order
+    examples = {}
+    lines = [line.strip() for line in open(path, encoding='utf-8')]
+    for prev, line in zip(lines, lines[1:]):
+        if prev.startswith('LCD->Printer') and line.startswith('note over LCD,Printer:'):
+            text = re.split(r' or |,', line.split(':', 1)[1])[0].strip()
+            addr = re.match(r'A\d+', text)
+            if addr:
+                examples.setdefault(addr.group(), []).append(text)
+    return examples
+
+
+def scenario_commands(examples):
+    scenarios = []
+    for name, steps in SCENARIOS:
+        commands = []
+        for step in steps:
+            commands.extend([step] if ' ' in step else examples[step])
+        scenarios.append((name, [c.encode('ascii') for c in commands]))
+    return scenarios
+
+
+class FakeTFT:
+    def __init__(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.lines = queue.Queue()
+        threading.Thread(target=self.reader, daemon=True).start()
+
+    def reader(self):
+        buf = b''
+        while True:
+            try:
+                data = os.read(self.master, 65536)
+            except OSError:
+                return
+            now = time.perf_counter()
+            buf += data
+            *lines, buf = buf.split(b'\n')
+            for line in lines:
+                self.lines.put((now, line.strip()))
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def wait_sync(self, count=1):
+        # Time of the count-th sync reply from now on
+        while True:
+            stamp, line = self.lines.get(timeout=REPLY_TIMEOUT)
+            if line.startswith(SYNC_REPLY):
+                count -= 1
+                if count == 0:
+                    return stamp
+
+    def drain(self):
+        while not self.lines.empty():
+            self.lines.get_nowait()
+
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def main():
+    argv = [arg for arg in sys.argv[1:] if arg != '--asyncio']
+    use_runtime = len(argv) < len(sys.argv) - 1
+    rounds = int(argv[0]) if argv else 20
+    tmp = tempfile.mkdtemp()
+    os.environ['XDG_CACHE_HOME'] = tmp
+
+    from main import KlipperLCD
+
+    scenarios = scenario_commands(diagram_commands())
+    # The stand-ins run in their own process so CPU time is the bridge's
+    fakes = subprocess.Popen([sys.executable, os.path.join(HERE, 'fakes.py'), os.path.join(tmp, 'klippy.sock')],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    moonraker_port = int(fakes.stdout.readline())
+    tft = FakeTFT()
+
+    latencies = {}
+    threads_max = 0
+    failed = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if use_runtime:
+            from runtime import Runtime
+            runtime = Runtime()
+            threading.Thread(target=runtime.run, daemon=True, args=(
+                lambda rt: KlipperLCD(lcd_port=tft.port, moonraker_port=moonraker_port, runtime=rt),
+                False)).start()
+            if not runtime.ready.wait(REPLY_TIMEOUT):
+                print('runtime did not start')
+                os._exit(1)
+            app = runtime.app
+        else:
+            app = KlipperLCD(lcd_port=tft.port, moonraker_port=moonraker_port)
+            app.start()
+        # Startup runs in the background, the polls are answered meanwhile
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        while not app.ready and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.5)
+        tft.drain()
+
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        count = 0
+        try:
+            for _ in range(rounds):
+                for name, commands in scenarios:
+                    for cmd in commands:
+                        start = time.perf_counter()
+                        tft.write(cmd + b'\r\n' + SYNC + b'\r\n')
+                        stamp = tft.wait_sync(2 if cmd == SYNC else 1)
+                        latencies.setdefault(cmd.split()[0].decode(), []).append(stamp - start)
+                        count += 1
+                        threads_max = max(threads_max, threading.active_count())
+        except queue.Empty:
+            failed = cmd.decode()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+
+        burst = None
+        if failed is None:
+            polls = scenarios[0][1]
+            batch = b''.join(cmd + b'\r\n' for cmd in polls) * rounds * 10 + SYNC + b'\r\n'
+            sent = len(polls) * rounds * 10 + 1
+            syncs = sum(1 for cmd in polls if cmd == SYNC) * rounds * 10 + 1
+            tft.drain()
+            start = time.perf_counter()
+            burst_cpu = time.process_time()
+            tft.write(batch)
+            try:
+                end = tft.wait_sync(syncs)
+                burst = (sent / (end - start), (time.process_time() - burst_cpu) / sent)
+            except queue.Empty:
+                failed = 'status poll burst'
+
+    print('%-6s %6s %10s %10s %10s' % ('cmd', 'n', 'p50 ms', 'p99 ms', 'max ms'))
+    samples_all = []
+    for addr in sorted(latencies, key=lambda a: int(a[1:])):
+        samples = sorted(latencies[addr])
+        samples_all.extend(samples)
+        print('%-6s %6d %10.2f %10.2f %10.2f' % (
+            addr, len(samples), percentile(samples, 0.5) * 1e3,
+            percentile(samples, 0.99) * 1e3, samples[-1] * 1e3))
+    samples_all.sort()
+    if samples_all:
+        print()
+        print('round trip    p50 %.2f ms  p99 %.2f ms  (%d commands)' % (
+            percentile(samples_all, 0.5) * 1e3, percentile(samples_all, 0.99) * 1e3, len(samples_all)))
+        print('sequential    %.0f cmd/s  %.3f ms CPU/cmd' % (count / wall, cpu / count * 1e3))
+    if burst:
+        print('poll burst    %.0f cmd/s  %.3f ms CPU/cmd' % (burst[0], burst[1] * 1e3))
+    print('threads       %d peak%s' % (threads_max, ', asyncio runtime' if use_runtime else ''))
+    if failed:
+        print('no reply to %s within %.0f s' % (failed, REPLY_TIMEOUT))
+    sys.stdout.flush()
+    fakes.kill()
+
+    # The LCD reader and update threads block without a way to stop them
+    os._exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
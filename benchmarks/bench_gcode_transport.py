@@ -0,0 +1,60 @@
+# Round trip latency of PrinterData.sendGCode per transport.
+#
+# Starts a FakeKlippy and a FakeMoonraker in this process and sends the
+# same script sequentially over HTTP (POST /printer/gcode/script, which
+# Moonraker forwards to Klippy) and directly over the Klippy socket.
+#
+#   python3 benchmarks/bench_gcode_transport.py [iterations]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fakes import FakeKlippy, FakeMoonraker
+from printer import PrinterData
+
+
+def run(printer, transport, iterations):
+    printer.gcode_transport = transport
+    for _ in range(20):
+        printer.sendGCode('G91').result()
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        printer.sendGCode('G1 X%d F3000' % (i % 2)).result()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    tmp = tempfile.mkdtemp()
+    klippy = FakeKlippy(os.path.join(tmp, 'klippy.sock'))
+    moonraker = FakeMoonraker(klippy.path)
+    printer = PrinterData('', URL='127.0.0.1', port=moonraker.port)
+    printer.start()
+    deadline = time.monotonic() + 5
+    while not printer.ks.connected:
+        if time.monotonic() > deadline:
+            sys.exit('no connection to the fake Klippy')
+        time.sleep(0.01)
+
+    print('%-8s %10s %10s %10s %10s' % ('path', 'mean us', 'p50 us', 'p99 us', 'cmd/s'))
+    for transport in ('http', 'klippy'):
+        samples = run(printer, transport, iterations)
+        mean = sum(samples) / len(samples)
+        print('%-8s %10.1f %10.1f %10.1f %10.0f' % (
+            transport, mean * 1e6, samples[len(samples) // 2] * 1e6,
+            samples[int(len(samples) * 0.99)] * 1e6, 1 / mean))
+
+    printer.ks.klippyExit()
+    moonraker.close()
+    klippy.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Throughput benchmark for decoding Klippy socket traffic.
+#
+# Feeds a stream of ETX terminated JSON messages through the former
+# str based splitting in KlippySocket.process_socket and through
+# MessageFramer + the configured JSON backend, in recv() sized chunks.
+#
+# Without arguments a synthetic stream resembling a print is generated
+# (status updates, gcode responses with UTF-8 and a large configfile
+# reply). A recorded capture of raw socket bytes can be given instead:
+#
+#   python3 benchmarks/bench_klippy_framing.py [capture.bin] [chunk_size]
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from printer import MessageFramer, json_loads, orjson
+
+
+def synthetic_traffic():
+    frames = []
+    config = {'printer': {'kinematics': 'cartesian', 'max_velocity': '300'}}
+    for i in range(3000):
+        config['gcode_macro M%d' % i] = {'gcode': '\n'.join('G1 X%d Y%d F3000' % (j, j) for j in range(20))}
+    frames.append({'id': 4002, 'result': {'eventtime': 1.0, 'status': {'configfile': {'config': config}}}})
+    for i in range(20000):
+        t = 1000.0 + i * 0.25
+        if i % 10 == 0:
+            frames.append({'params': {'response': '// Température %.1f°C reached' % (200 + i % 7)}})
+        frames.append({'params': {'eventtime': t, 'status': {
+            'extruder': {'temperature': 200.0 + (i % 13) / 10},
+            'heater_bed': {'temperature': 60.0 + (i % 7) / 10},
+            'toolhead': {'position': [i % 220 + 0.5, (i * 3) % 220 + 0.25, 0.2 + i // 1000 * 0.2, i * 0.04]},
+            'virtual_sdcard': {'progress': i / 20000.0, 'file_position': i * 512},
+            'print_stats': {'print_duration': t, 'total_duration': t + 30},
+        }}})
+    return b''.join(json.dumps(f, ensure_ascii=False).encode('utf-8') + b'\x03' for f in frames)
+
+
+def legacy_decode(chunks):
+    # String based splitting as done before MessageFramer
+    socket_data = ''
+    count = errors = 0
+    for chunk in chunks:
+        try:
+            data = chunk.decode()
+        except UnicodeDecodeError:
+            errors += 1
+            continue
+        parts = data.split('\x03')
+        parts[0] = socket_data + parts[0]
+        socket_data = parts.pop()
+        for line in parts:
+            try:
+                json.loads(line)
+            except ValueError:
+                # Frame corrupted by a chunk lost to a split UTF-8 character
+                errors += 1
+                continue
+            count += 1
+    return count, errors
+
+
+def framer_decode(chunks, loads=json_loads):
+    framer = MessageFramer()
+    count = 0
+    for chunk in chunks:
+        for frame in framer.feed(chunk):
+            loads(frame)
+            count += 1
+    return count, 0
+
+
+def framer_stdlib_decode(chunks):
+    return framer_decode(chunks, lambda frame: json.loads(frame.decode('utf-8')))
+
+
+def run(name, fn, chunks, size):
+    start = time.perf_counter()
+    count, errors = fn(chunks)
+    elapsed = time.perf_counter() - start
+    print("%-8s %8d frames %6d errors %8.3f s %8.1f MB/s %10.0f frames/s" % (
+        name, count, errors, elapsed, size / elapsed / 1e6, count / elapsed))
+
+
+def main():
+    path = None
+    chunk_size = 4096
+    for arg in sys.argv[1:]:
+        if arg.isdigit():
+            chunk_size = int(arg)
+        else:
+            path = arg
+    if path:
+        with open(path, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = synthetic_traffic()
+    chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+    print("%d bytes in %d chunks of %d bytes, JSON backend: %s" % (
+        len(stream), len(chunks), chunk_size, 'orjson' if orjson is not None else 'json'))
+    run('legacy', legacy_decode, chunks, len(stream))
+    run('framer', framer_stdlib_decode, chunks, len(stream))
+    if orjson is not None:
+        run('orjson', framer_decode, chunks, len(stream))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# Local stand-ins for Klippy and Moonraker used by the benchmarks.
+#
+# FakeKlippy listens on a unix socket and answers the requests the
+# bridge makes (objects/subscribe, objects/query, gcode/script, ...).
+# FakeMoonraker serves the HTTP endpoints PrinterData reads during
+# startup and forwards /printer/gcode/script to the FakeKlippy over its
+# own socket connection, the same hop the real Moonraker adds.
+
+import json
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+STATUS = {
+    'extruder': {'temperature': 21.3, 'target': 0.0},
+    'heater_bed': {'temperature': 22.1, 'target': 0.0},
+    'gcode_move': {'homing_origin': [0, 0, 0.1, 0], 'gcode_position': [0, 0, 5.0, 0], 'extrude_factor': 1.0,
+                   'absolute_coordinates': True, 'absolute_extrude': True, 'speed': 25.0, 'speed_factor': 1.0},
+    'fan': {'speed': 0.0},
+    'print_stats': {'filename': '', 'state': 'standby', 'total_duration': 0.0, 'print_duration': 0.0},
+    'display_status': {'progress': 0.0, 'message': None},
+    'virtual_sdcard': {'is_active': False, 'progress': 0.0, 'file_position': 0, 'file_path': None},
+    'toolhead': {'position': [0, 0, 5.0, 0], 'homed_axes': '', 'max_velocity': 300, 'max_accel': 3000,
+                 'minimum_cruise_ratio': 0.5, 'square_corner_velocity': 5.0, 'axis_maximum': [220, 220, 250, 0]},
+    'motion_report': {'live_position': [0, 0, 0, 0]},
+    'configfile': {'config': {'virtual_sdcard': {'path': '/tmp/gcodes'}}},
+}
+FILES = [{'path': 'a.gcode', 'modified': 1.0, 'size': 10}, {'path': 'dir/b.gcode', 'modified': 2.0, 'size': 20}]
+
+
+def select(objs):
+    out = {}
+    for name, fields in objs.items():
+        src = STATUS.get(name, {})
+        out[name] = dict(src) if not fields else {f: src[f] for f in fields if f in src}
+    return out
+
+
+def frames(sock):
+    buf = b''
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return
+        buf += data
+        while b'\x03' in buf:
+            frame, buf = buf.split(b'\x03', 1)
+            yield json.loads(frame)
+
+
+class FakeKlippy:
+    def __init__(self, path, script_delay=0.0):
+        self.path = path
+        self.script_delay = script_delay
+        self.scripts = []
+        self.clients = []
+        if os.path.exists(path):
+            os.unlink(path)
+        self.srv = socket.socket(socket.AF_UNIX)
+        self.srv.bind(path)
+        self.srv.listen(8)
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.srv.accept()
+            except OSError:
+                return
+            self.clients.append(client)
+            threading.Thread(target=self.serve, args=(client,), daemon=True).start()
+
+    def serve(self, client):
+        try:
+            for msg in frames(client):
+                method = msg.get('method')
+                params = msg.get('params', {})
+                if method in ('objects/subscribe', 'objects/query'):
+                    result = {'eventtime': time.time(), 'status': select(params['objects'])}
+                elif method == 'gcode/script':
+                    if self.script_delay:
+                        time.sleep(self.script_delay)
+                    self.scripts.append(params['script'])
+                    result = {}
+                else:
+                    result = {}
+                client.sendall(json.dumps({'id': msg.get('id'), 'result': result}).encode() + b'\x03')
+        except OSError:
+            pass
+
+    def push(self, status):
+        msg = json.dumps({'params': {'eventtime': time.time(), 'status': status}}).encode() + b'\x03'
+        for client in list(self.clients):
+            try:
+                client.sendall(msg)
+            except OSError:
+                pass
+
+    def close(self):
+        self.srv.close()
+        for client in self.clients:
+            # shutdown() first, close() alone does not end a blocked recv()
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class KlippyForwarder:
+    # A single shared connection, scripts reach Klippy one at a time as
+    # they do through Moonraker
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sock = None
+        self.next_id = 0
+        self.buf = b''
+
+    def call(self, method, params):
+        with self.lock:
+            if self.sock is None:
+                self.sock = socket.socket(socket.AF_UNIX)
+                self.sock.connect(self.path)
+            self.next_id += 1
+            self.sock.sendall(json.dumps({'id': self.next_id, 'method': method, 'params': params}).encode() + b'\x03')
+            while b'\x03' not in self.buf:
+                data = self.sock.recv(65536)
+                if not data:
+                    raise ConnectionError('klippy closed')
+                self.buf += data
+            frame, self.buf = self.buf.split(b'\x03', 1)
+            return json.loads(frame).get('result')
+
+
+class FakeMoonraker:
+    def __init__(self, klippy_path, port=0):
+        outer = self
+        self.posts = []
+        self.forwarder = KlippyForwarder(klippy_path)
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, without this the
+            # keep-alive connection stalls on delayed ACKs
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, obj):
+                body = json.dumps(obj).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/server/config':
+                    return self.reply({'result': {'config': {'server': {'klippy_uds_address': klippy_path}}}})
+                if url.path == '/printer/objects/list':
+                    return self.reply({'result': {'objects': list(STATUS)}})
+                if url.path == '/printer/objects/query':
+                    query = parse_qs(url.query, keep_blank_values=True)
+                    objs = {k: (v[0].split(',') if v[0] else None) for k, v in query.items()}
+                    return self.reply({'result': {'status': select(objs)}})
+                if url.path == '/machine/update/status':
+                    return self.reply({'result': {'version_info': {'klipper': {'version': 'v0.12.0'}}}})
+                if url.path == '/server/files/list':
+                    return self.reply({'result': FILES})
+                if url.path == '/server/files/metadata':
+                    return self.reply({'result': {'estimated_time': 3600, 'filament_total': 1000}})
+                return self.reply({'result': {}})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                outer.posts.append(self.path)
+                if urlparse(self.path).path == '/printer/gcode/script':
+                    outer.forwarder.call('gcode/script', {'script': json.loads(body)['script']})
+                self.reply({'result': 'ok'})
+
+        self.srv = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.port = self.srv.server_address[1]
+        threading.Thread(target=self.srv.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.srv.shutdown()
+        self.srv.server_close()
+
+
+if __name__ == '__main__':
+    # Serve both stand-ins from a separate process, prints the HTTP port
+    import sys
+    klippy = FakeKlippy(sys.argv[1])
+    moonraker = FakeMoonraker(klippy.path)
+    print(moonraker.port, flush=True)
+    sys.stdin.read()
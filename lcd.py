@@ -1,16 +1,66 @@
+import os
 import re
-import inspect
+import time
+import logging
+import queue
 from threading import Thread
 
 import atexit
 import serial
 
+import log
+import metrics
+
 MaxFileNumber = 25
 
+# TX path: lines are queued and written by a single writer thread which
+# batches everything pending (up to TX_BATCH_BYTES) into one write().
+TX_QUEUE_SIZE   = 64
+TX_BATCH_BYTES  = 512
+TX_PUT_TIMEOUT  = 0.5
+
+# RX path: the reader takes whatever the UART has buffered in one read()
+# and splits it into frames itself. The timeout bounds how long a read
+# blocks, so the reader notices a stop within it.
+RX_TIMEOUT      = 0.1
+RX_READ_SIZE    = 4096
+RX_FRAME_MAX    = 96
+
+logger = log.get('lcd')
+rx_log = log.get('lcd.rx')
+tx_log = log.get('lcd.tx')
+
+CMD_UNKNOWN    = metrics.counter('klippertft_lcd_commands_unknown_total', 'TFT lines that did not parse')
+TX_WRITE_TIME  = metrics.histogram('klippertft_lcd_tx_write_seconds', 'Time of one serial write')
+TX_WRITE_BYTES = metrics.histogram('klippertft_lcd_tx_write_bytes', 'Bytes per serial write', metrics.SIZE_BUCKETS)
+TX_BYTES       = metrics.counter('klippertft_lcd_tx_bytes_total', 'Bytes written to the TFT')
+TX_LINES       = metrics.counter('klippertft_lcd_tx_lines_total', 'Lines written to the TFT')
+TX_DROPPED     = metrics.counter('klippertft_lcd_tx_dropped_total', 'Lines dropped on a full TX queue')
+RX_READS       = metrics.counter('klippertft_lcd_rx_reads_total', 'Serial reads that returned data')
+RX_BYTES       = metrics.counter('klippertft_lcd_rx_bytes_total', 'Bytes read from the TFT')
+RX_FRAMES      = metrics.counter('klippertft_lcd_rx_frames_total', 'Complete frames received from the TFT')
+RX_DROPPED     = metrics.counter('klippertft_lcd_rx_dropped_total', 'Malformed frames and noise dropped by the receiver')
+
+# _printerData fields each poll response is rendered from
+POLL_FIELDS = {
+    'A0':  ('hotend',),
+    'A1':  ('hotend_target',),
+    'A2':  ('bed',),
+    'A3':  ('bed_target',),
+    'A4':  ('fan',),
+    'A5':  ('x_pos', 'y_pos', 'z_pos'),
+    'A6':  ('percent',),
+    'A7':  ('remaining',),
+    'A20': ('feedrate',),
+}
+
+# Receiver states. TFT frames are "A<n>[ args]" terminated by CR and/or
+# LF, they carry no length so RX_STATE_READ_LEN is not used.
 RX_STATE_IDLE = 0
 RX_STATE_READ_LEN = 1
 RX_STATE_READ_CMD = 2
 RX_STATE_READ_DAT = 3
+RX_STATE_DISCARD = 4
 
 PLA   = 0
 ABS   = 1
@@ -18,6 +68,58 @@ PETG  = 2
 TPU   = 3
 PROBE = 4
 
+# Precompiled parsers for the arguments of TFT commands. They work on the raw
+# bytes received from the display, starting behind the A<n> address, and
+# return the positional arguments for the handler or None if malformed.
+_ADDR_RE      = re.compile(rb'A\d+')
+_S_PARAM_RE   = re.compile(rb'S(\d+)')
+_C_PARAM_RE   = re.compile(rb'C(\d+)')
+_ALT_NAME_RE  = re.compile(rb'<[^>]+>')
+_MOVE_AXIS_RE = re.compile(rb'\s+([XYZ])\s*([+-]?\d+(?:\.\d+)?)\s*F(\d+)')
+_PLAIN_RE     = re.compile(rb'[a-zA-Z0-9_./-]+')
+_NO_ARGS      = ()
+_RX_TERM_RE   = re.compile(rb'[\r\n]')
+_RX_NOISE_RE  = re.compile(rb'[^\x20-\x7e]')
+_DIGITS       = frozenset(b'0123456789')
+
+def _parse_none(data, pos):
+    return _NO_ARGS
+
+def _parse_s_int(data, pos):
+    # A8 S4, A20 S100 or just A20
+    m = _S_PARAM_RE.search(data, pos)
+    if m:
+        return (int(m.group(1)),)
+    return _NO_ARGS
+
+def _parse_c_param(data, pos):
+    # Setpoints are sent as A16 S240, or A16 C240 when they should not wait
+    m = _S_PARAM_RE.search(data, pos) or _C_PARAM_RE.search(data, pos)
+    if m:
+        return (int(m.group(1)),)
+    return None
+
+def _parse_alt_name(data, pos):
+    # A13 <1-d.idx>
+    m = _ALT_NAME_RE.search(data, pos)
+    if m:
+        return (m.group().decode('utf-8', 'replace'),)
+    return None
+
+def _parse_move(data, pos):
+    # A22 X +10F3000
+    m = _MOVE_AXIS_RE.match(data, pos)
+    if m:
+        return (m.group(1).decode('ascii'), m.group(2).decode('ascii'), m.group(3).decode('ascii'))
+    return None
+
+def _parse_plain(data, pos):
+    # A21 C
+    m = _PLAIN_RE.search(data, pos)
+    if m:
+        return (m.group().decode('ascii'),)
+    return None
+
 
 class _printerData():
     hotend_target   = None
@@ -78,6 +180,7 @@ class LCDEvents():
     THUMBNAIL      = 28
     CONSOLE        = 29
     MOVE           = 30
+    METADATA       = 31
 
 
 class LCD:
@@ -85,34 +188,41 @@ class LCD:
 
     def __init__(self, port=None, baud=115200, callback=None):
         self.addr_func_map = {
-            'A0': self._GetHotEndTemp,
-            'A1': self._GetHotEndTargetTemp,
-            'A2': self._GetHeatBedTemp,
-            'A3': self._GetHeatBedTargetTemp,
-            'A4': self._GetPartFanSpeed,
-            'A5': self._GetCurrentPos,
-            'A6': self._GetProgress,
-            'A7': self._GetPrintingTime,
-            'A8': self._GetGcodeFileList,
-            'A9': self._PausePrint,
-            'A10': self._ResumePrint,
-            'A11': self._StopPrint,
-            'A12': self._KillPrint,
-            'A13': self._SelectFile,
-            'A14': self._StartPrint,
-            'A15': self._ResumeFromPowerOutage,
-            'A16': self._SetHotEndTemp,
-            'A17': self._SetHeatBedTemp,
-            'A18': self._SetFanSpeed,
-            'A19': self._StopStepperMotors,
-            'A20': self._GetSetPrintingSpeed,
-            'A21': self._HomeAll,
-            'A22': self._MoveAxis,
-            'A23': self._PreHeatPLA,
-            'A24': self._PreHeatABS,
-            'A25': self._CoolDown,
-            'A26': self._RefreshFileList,
-            'A33': self._GetVersionInfo
+            'A0':  (self._GetHotEndTemp,         _parse_none),
+            'A1':  (self._GetHotEndTargetTemp,   _parse_none),
+            'A2':  (self._GetHeatBedTemp,        _parse_none),
+            'A3':  (self._GetHeatBedTargetTemp,  _parse_none),
+            'A4':  (self._GetPartFanSpeed,       _parse_none),
+            'A5':  (self._GetCurrentPos,         _parse_none),
+            'A6':  (self._GetProgress,           _parse_none),
+            'A7':  (self._GetPrintingTime,       _parse_none),
+            'A8':  (self._GetGcodeFileList,      _parse_s_int),
+            'A9':  (self._PausePrint,            _parse_none),
+            'A10': (self._ResumePrint,           _parse_none),
+            'A11': (self._StopPrint,             _parse_none),
+            'A12': (self._KillPrint,             _parse_none),
+            'A13': (self._SelectFile,            _parse_alt_name),
+            'A14': (self._StartPrint,            _parse_none),
+            'A15': (self._ResumeFromPowerOutage, _parse_none),
+            'A16': (self._SetHotEndTemp,         _parse_c_param),
+            'A17': (self._SetHeatBedTemp,        _parse_c_param),
+            'A18': (self._SetFanSpeed,           _parse_c_param),
+            'A19': (self._StopStepperMotors,     _parse_none),
+            'A20': (self._GetSetPrintingSpeed,   _parse_s_int),
+            'A21': (self._HomeAll,               _parse_plain),
+            'A22': (self._MoveAxis,              _parse_move),
+            'A23': (self._PreHeatPLA,            _parse_none),
+            'A24': (self._PreHeatABS,            _parse_none),
+            'A25': (self._CoolDown,              _parse_none),
+            'A26': (self._RefreshFileList,       _parse_none),
+            'A33': (self._GetVersionInfo,        _parse_none)
+        }
+        # Dispatch table keyed by the raw address bytes received from the TFT,
+        # with the latency histogram of each address
+        self.cmd_table = {
+            addr.encode('ascii'): (func, parser, metrics.histogram(
+                'klippertft_lcd_command_seconds', 'Time to handle a TFT command', addr=addr))
+            for addr, (func, parser) in self.addr_func_map.items()
         }
 
         self.evt = LCDEvents()
@@ -126,15 +236,37 @@ class LCD:
         self.ser = serial.Serial()
         self.ser.port = port
         self.ser.baudrate = baud
-        self.ser.timeout = None
+        self.ser.timeout = RX_TIMEOUT
         self.running = False
+        # Set by start() when an event loop serves the port (see runtime.py)
+        self.loop = None
+        self.dispatch = None
+        self.tx_queue = queue.Queue(TX_QUEUE_SIZE)
+        self.tx_thread = None
+        self.tx_pending = bytearray()
+        self.tx_batch = None
+        self.tx_wakeup = False
+        metrics.gauge('klippertft_lcd_tx_queue', 'Lines waiting for the serial writer', self.tx_queue.qsize)
+        self.tx_lines = 0
+        self.tx_writes = 0
+        self.tx_bytes = 0
+        self.tx_collapsed = 0
+        self.tx_dropped = 0
+        self.tx_write_time = 0.0
+        self.tx_write_time_max = 0.0
         self.rx_buf = bytearray()
         self.rx_data_cnt = 0
         self.rx_state = RX_STATE_IDLE
+        self.rx_noise = False
+        self.rx_frames = 0
+        self.rx_dropped = 0
         self.error_from_lcd = False
         # List of GCode files
         self.files = None
         self.file_dict = {}
+        self.folder_children = {'<0-d.idx>': []}
+        self.alt_name_nodes = {}
+        self.parent_alt_names = {}
         self.selected_file = None
         self.current_dir = '<0-d.idx>'
         self.waiting = None
@@ -157,23 +289,127 @@ class LCD:
         # Thumbnail
         self.is_thumbnail_written = False
         self.askprint = False
+        # Pre-encoded responses for the poll commands
+        self.poll_cache = {}
+        self.poll_keys = {}
+        self._update_poll_cache()
         # Make sure the serial port closes when you quit the program.
         atexit.register(self._atexit)
 
     def _atexit(self):
-        self.ser.close()
         self.running = False
+        if self.tx_thread:
+            try:
+                self.tx_queue.put_nowait(None)
+            except queue.Full:
+                pass
+            self.tx_thread.join(1)
+        self.ser.close()
 
-    def start(self, *args, **kwargs):
+    def start(self, loop=None, dispatch=None):
+        # Without a loop the port gets a reader and a writer thread. With
+        # one, it reads and writes the port's fd and hands received frames
+        # to dispatch(fn, *args).
         self.running = True
         self.ser.open()
-        self.send_line("J17") # Reset display
-        Thread(target=self.run).start()
+        if loop is None:
+            self.tx_thread = Thread(target=self._tx_writer, daemon=True)
+            self.tx_thread.start()
+            self.send_line("J17") # Reset display
+            Thread(target=self.run).start()
+        else:
+            self.loop = loop
+            self.dispatch = dispatch
+            loop.call_soon_threadsafe(self.attach)
+            self.send_line("J17") # Reset display
 
     def send_line(self, *messages):
         full_message = " ".join(messages) + "\r\n"
-        print(f"[TX] {full_message.strip()} [HEX: {full_message.encode('ascii').hex(' ')}]")
-        self.ser.write(full_message.encode('ascii'))
+        self.send_raw(full_message.encode('ascii'))
+
+    def send_raw(self, data):
+        # With a loop this runs on the app thread, the loop writes when the
+        # port takes it
+        try:
+            self.tx_queue.put(data, timeout=TX_PUT_TIMEOUT)
+        except queue.Full:
+            self._tx_drop(data)
+            return
+        if self.loop is not None and not self.tx_wakeup:
+            # One wakeup for everything queued until the loop drains it
+            self.tx_wakeup = True
+            try:
+                self.loop.call_soon_threadsafe(self.loop_write)
+            except RuntimeError:
+                pass # Loop closed, shutting down
+
+    def _tx_drop(self, data):
+        self.tx_dropped += 1
+        TX_DROPPED.inc()
+        tx_log.warning("queue full, dropped %r", data)
+
+    def _tx_batch(self, line):
+        # Coalesce whatever else is pending into the same write. Returns the
+        # lines, their size and whether the stop marker was taken.
+        batch = [line]
+        size = len(line)
+        while size < TX_BATCH_BYTES:
+            try:
+                line = self.tx_queue.get_nowait()
+            except queue.Empty:
+                break
+            if line is None:
+                return batch, size, True
+            if line == batch[-1] and line[:1] == b'J':
+                # Repeated state line (J04, J12, ...) carries no news
+                self.tx_collapsed += 1
+                continue
+            batch.append(line)
+            size += len(line)
+        return batch, size, False
+
+    def _tx_writer(self):
+        stop = False
+        while not stop:
+            line = self.tx_queue.get()
+            if line is None:
+                break
+            batch, size, stop = self._tx_batch(line)
+
+            start = time.monotonic()
+            try:
+                self.ser.write(b"".join(batch))
+            except Exception as e:
+                tx_log.error("write failed: %s", e)
+                continue
+            self._tx_account(batch, size, time.monotonic() - start)
+
+    def _tx_account(self, batch, size, elapsed):
+        self.tx_lines += len(batch)
+        self.tx_writes += 1
+        self.tx_bytes += size
+        self.tx_write_time += elapsed
+        if elapsed > self.tx_write_time_max:
+            self.tx_write_time_max = elapsed
+        TX_WRITE_TIME.observe(elapsed)
+        TX_WRITE_BYTES.observe(size)
+        TX_BYTES.inc(size)
+        TX_LINES.inc(len(batch))
+        if tx_log.isEnabledFor(logging.DEBUG):
+            for line in batch:
+                tx_log.debug("%s", line.decode('ascii').strip())
+
+    def tx_stats(self):
+        return {
+            'queue_depth': self.tx_queue.qsize(),
+            'lines': self.tx_lines,
+            'writes': self.tx_writes,
+            'bytes': self.tx_bytes,
+            'collapsed': self.tx_collapsed,
+            'dropped': self.tx_dropped,
+            'write_time_avg': self.tx_write_time / self.tx_writes if self.tx_writes else 0.0,
+            'write_time_max': self.tx_write_time_max,
+        }
 
     def data_update(self, data):
         # Raise Error Pop-Up when hotend as unplausible Temperature
@@ -198,66 +434,225 @@ class LCD:
         if data != self.printer:
             self.printer = data
 
+        self._update_poll_cache()
+
+    def _update_poll_cache(self):
+        for addr, fields in POLL_FIELDS.items():
+            values = tuple(getattr(self.printer, field) for field in fields)
+            if self.poll_keys.get(addr) != values:
+                self.poll_cache[addr] = self._render_poll(addr, values)
+                self.poll_keys[addr] = values
+
+    def _render_poll(self, addr, values):
+        if addr == 'A5':
+            x, y, z = (0.0 if v is None else v for v in values)
+            message = "A5V X: %s Y: %s Z: %s" % (x, y, z)
+        elif addr == 'A6' or addr == 'A20':
+            message = "%sV %s" % (addr, 0.0 if values[0] is None else values[0])
+        elif addr == 'A7':
+            hours, minutes = self.convert_seconds_to_time(values[0])
+            message = "A7V %s H %s M" % (hours, minutes)
+        else:
+            message = "%sV %s" % (addr, 0 if values[0] is None else values[0])
+        return (message + "\r\n").encode('ascii')
+
     def run(self):
         while self.running:
-            data = self.ser.readline().strip()
-            self.handle_command(data)
+            try:
+                # Block for the first byte, then take everything pending
+                waiting = self.ser.in_waiting
+                data = self.ser.read(min(waiting, RX_READ_SIZE) if waiting else 1)
+            except (serial.SerialException, OSError, TypeError) as e:
+                if self.running:
+                    rx_log.error("read failed: %s", e)
+                    time.sleep(RX_TIMEOUT)
+                continue
+            if not data:
+                continue
+            RX_READS.inc()
+            RX_BYTES.inc(len(data))
+            self.handle_frames(self.rx_feed(data))
+
+    # Event loop counterparts of run() and _tx_writer(), called on the loop
+    def attach(self):
+        self.loop.add_reader(self.ser.fileno(), self.loop_receive)
+        self.loop_write()
+
+    def detach(self):
+        if self.loop is not None and self.ser.is_open:
+            self.loop.remove_reader(self.ser.fileno())
+            self.loop.remove_writer(self.ser.fileno())
+
+    def loop_receive(self):
+        try:
+            data = os.read(self.ser.fileno(), RX_READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            data = None
+            rx_log.error("read failed: %s", e)
+        if not data:
+            rx_log.error("serial port closed")
+            self.loop.remove_reader(self.ser.fileno())
+            return
+        RX_READS.inc()
+        RX_BYTES.inc(len(data))
+        frames = self.rx_feed(data)
+        if frames:
+            self.dispatch(self.handle_frames, frames)
+
+    def loop_write(self):
+        self.tx_wakeup = False
+        fd = self.ser.fileno()
+        while True:
+            if not self.tx_pending:
+                try:
+                    line = self.tx_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if line is None:
+                    break
+                batch, size, _ = self._tx_batch(line)
+                self.tx_pending += b"".join(batch)
+                self.tx_batch = (batch, size)
+            start = time.monotonic()
+            try:
+                sent = os.write(fd, self.tx_pending)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError as e:
+                tx_log.error("write failed: %s", e)
+                self.tx_pending.clear()
+                continue
+            elapsed = time.monotonic() - start
+            del self.tx_pending[:sent]
+            if self.tx_pending:
+                # Port buffer full, continue once it drains
+                self.loop.add_writer(fd, self.loop_write)
+                return
+            self._tx_account(*self.tx_batch, elapsed)
+        self.loop.remove_writer(fd)
+
+    def handle_frames(self, frames):
+        for frame in frames:
+            self.handle_command(frame)
+
+    def rx_feed(self, data):
+        # Appends received bytes to rx_buf and returns the complete frames.
+        # rx_buf only holds the frame in progress, rx_data_cnt how much of
+        # it has already been scanned for a terminator.
+        buf = self.rx_buf
+        buf += data
+        frames = []
+        pos = 0
+        start = 0
+        end = len(buf)
+        while pos < end:
+            state = self.rx_state
+            if state == RX_STATE_IDLE:
+                # Between frames, anything but line ends before an 'A' is noise
+                start = buf.find(b'A', pos)
+                if start < 0:
+                    start = end
+                if buf[pos:start].strip():
+                    # Counted once per run, however it was split by reads
+                    if not self.rx_noise:
+                        self._rx_drop(buf[pos:start])
+                    self.rx_noise = True
+                pos = start
+                if pos < end:
+                    self.rx_noise = False
+                    self.rx_state = RX_STATE_READ_CMD
+                    self.rx_data_cnt = 1
+            elif state == RX_STATE_READ_CMD:
+                # Address digits
+                i = start + self.rx_data_cnt
+                while i < end and buf[i] in _DIGITS:
+                    i += 1
+                self.rx_data_cnt = i - start
+                pos = i
+                if i == end:
+                    break
+                if self.rx_data_cnt == 1:
+                    self.rx_state = RX_STATE_DISCARD
+                    self._rx_drop(buf[start:i + 1])
+                else:
+                    self.rx_state = RX_STATE_READ_DAT
+            elif state == RX_STATE_READ_DAT:
+                # Arguments up to the line end
+                term = _RX_TERM_RE.search(buf, start + self.rx_data_cnt)
+                if term is None:
+                    pos = end
+                    self.rx_data_cnt = end - start
+                    if self.rx_data_cnt > RX_FRAME_MAX:
+                        self.rx_state = RX_STATE_DISCARD
+                        self._rx_drop(buf[start:end])
+                    break
+                pos = term.end()
+                self.rx_state = RX_STATE_IDLE
+                frame = bytes(buf[start:term.start()]).rstrip()
+                if len(frame) > RX_FRAME_MAX or _RX_NOISE_RE.search(frame):
+                    self._rx_drop(frame)
+                else:
+                    frames.append(frame)
+            else:
+                # Rest of a malformed frame
+                term = _RX_TERM_RE.search(buf, pos)
+                if term is None:
+                    pos = end
+                else:
+                    pos = term.end()
+                    self.rx_state = RX_STATE_IDLE
+
+        # Keep only the frame in progress
+        if self.rx_state in (RX_STATE_READ_CMD, RX_STATE_READ_DAT):
+            del buf[:start]
+        else:
+            del buf[:]
+        if frames:
+            self.rx_frames += len(frames)
+            RX_FRAMES.inc(len(frames))
+        return frames
+
+    def _rx_drop(self, data):
+        self.rx_dropped += 1
+        RX_DROPPED.inc()
+        rx_log.debug("dropped malformed frame %r", bytes(data))
+
+    def _lookup(self, data):
+        match = _ADDR_RE.match(data)
+        if not match:
+            return None
+        entry = self.cmd_table.get(match.group())
+        if entry is None:
+            return None
+        args = entry[1](data, match.end())
+        if args is None:
+            return None
+        return entry, args
+
+    def parse_command(self, data):
+        command = self._lookup(data)
+        if command is None:
+            return None
+        return command[0][0], command[1]
 
     def handle_command(self, data):
-        decoded_data = data.decode('utf-8')
-        match = re.match(r'A\d+', decoded_data)
+        command = self._lookup(data)
 
-        if not match:
-            print(f"Command not recognized: {data}")
+        if command is None:
+            CMD_UNKNOWN.inc()
+            rx_log.warning("command not recognized: %r", data)
             return
 
-        addr = match.group(0)
-
-        print(decoded_data)
-
-        if addr in self.addr_func_map:
-            func = self.addr_func_map[addr]
-            # check function signature
-            sig = inspect.signature(func)
-            params = sig.parameters
-
-            # search for S param
-            s_param = re.search(r'S(\d+)', decoded_data)
-
-            # search for C param
-            c_param = re.search(r'C(\d+)', decoded_data)
-
-            # search for altnames
-            altname_param = re.search(r'<[^>]+>', decoded_data)
-
-            # search for A22 movement
-            moveAxismatch = re.match(r'A22\s+([XYZ])\s*([+-]?\d+(?:\.\d+)?)\s*F(\d+)', decoded_data)
-
-            # search for plain param
-            plain_param_match = re.search(r'([a-zA-Z0-9_./-]+)', decoded_data.split(addr)[-1].strip())
-            plain_param = plain_param_match.group(1) if plain_param_match else None
-
-
-            if len(params) == 0:
-                func()
-            elif s_param:
-                print(f"S_PARAM Found: {s_param.group(1)}")
-                func(int(s_param.group(1)))
-            elif c_param:
-                print(f"C_PARAM Found: {c_param.group(1)}")
-                func(c_param.group(1))
-            elif moveAxismatch:
-                func(axis=moveAxismatch.group(1), distance=moveAxismatch.group(2), speed=moveAxismatch.group(3))
-            elif altname_param:
-                print(f"alt_name: {altname_param.group()}")
-                func(altname_param.group())
-            elif plain_param:
-                print(f"Plain param: {plain_param}")
-                func(plain_param)
-            else:
-                func()  # Call without parameters if no valid parameters found.
-        else:
-            print(f"Command not recognized: {data}")
+        rx_log.debug("%s", data)
+
+        (func, _, latency), args = command
+        start = time.perf_counter()
+        try:
+            func(*args)
+        finally:
+            latency.observe(time.perf_counter() - start)
 
     ########
     # Required functions for file menu
@@ -294,32 +689,37 @@ class LCD:
             path_parts = file.split('/')
             folder_index = add_to_dict(path_parts, index, file, file_dict, folder_index)
 
+        self._IndexFileDict(file_dict)
         self.file_dict = file_dict
         return file_dict
 
-    def _RenderView(self, file_dict, folder, page_param=0):
-        print(f"file_dict {file_dict}")
-        print(f"folder {folder}")
-        print(f"page_param {page_param}")
-
-        def list_files_in_folder_by_alt_name(current_dict, folder_alt_name):
-            if not folder_alt_name:
-                return current_dict
-            for k, v in current_dict.items():
-                if v['alt_name'] == folder_alt_name:
-                    return v['files']
+    def _IndexFileDict(self, file_dict):
+        # Presorted children per folder plus alt_name -> node and
+        # alt_name -> parent maps, so rendering a page or going back up
+        # never has to walk the whole tree
+        folder_children = {}
+        alt_name_nodes = {}
+        parent_alt_names = {}
+
+        def index_folder(folder_alt_name, current_dict):
+            children = sorted(current_dict.items(), key=lambda item: item[0].lower())
+            folder_children[folder_alt_name] = children
+            for k, v in children:
+                alt_name_nodes[v['alt_name']] = v
+                parent_alt_names[v['alt_name']] = folder_alt_name
                 if v['type'] == 'dir':
-                    result = list_files_in_folder_by_alt_name(v['files'], folder_alt_name)
-                    if result:
-                        return result
-            return {}
+                    index_folder(v['alt_name'], v['files'])
 
-        sorted_file_dict = {k: v for k, v in sorted(file_dict.items(), key=lambda item: item[0].lower())}
+        index_folder('<0-d.idx>', file_dict)
 
-        if folder == '<0-d.idx>':
-            current_dict = sorted_file_dict
-        else:
-            current_dict = list_files_in_folder_by_alt_name(sorted_file_dict, folder)
+        self.folder_children = folder_children
+        self.alt_name_nodes = alt_name_nodes
+        self.parent_alt_names = parent_alt_names
+
+    def _RenderView(self, folder, page_param=0):
+        logger.debug("render folder %s page %s", folder, page_param)
+
+        current_items = self.folder_children.get(folder, [])
 
         items_per_page = 4
         start_index = page_param
@@ -331,9 +731,6 @@ class LCD:
             message_lines.append('<menu>')
             message_lines.append('<Special Menu>')
 
-        current_items = list(current_dict.items())
-        print("")
-        print(f"current_items {len(current_items[4:8])}")
         if self.current_dir == '<0-d.idx>' and page_param == 0:
             current_items = current_items[start_index:end_index - 1]  # Reserve space for Special Menu
         elif self.current_dir == '<0-d.idx>' and page_param > 0:
@@ -341,6 +738,7 @@ class LCD:
         else:
             current_items = current_items[start_index:end_index]
 
+        visible_files = []
         for k, v in current_items:
             if v['type'] == 'dir':
                 message_lines.append(v['alt_name'])
@@ -348,8 +746,10 @@ class LCD:
             else:
                 message_lines.append(v['alt_name'])
                 message_lines.append(k)
+                visible_files.append(v['original_name'])
 
-        if self.current_dir != '<0-d.idx>' and len(current_items[start_index:end_index]) < 4:
+        # Pages after the first one always offer the way back up
+        if self.current_dir != '<0-d.idx>' and (start_index > 0 or len(current_items) < items_per_page):
             message_lines.append('<back-d.idx>')
             message_lines.append('/..')
 
@@ -357,8 +757,13 @@ class LCD:
         full_message = "\r\n".join(message_lines)
         self.send_line(full_message)
 
+        # Warm the metadata cache for what is on screen
+        if visible_files:
+            self.callback(self.evt.METADATA, visible_files)
+
     def convert_seconds_to_time(self, seconds):
-        if seconds == 0.0:
+        # 999 tells the display the time is unknown
+        if seconds is None:
             return 999, 999
         total_minutes = int(seconds / 60)
         hrs = total_minutes // 60
@@ -371,92 +776,47 @@ class LCD:
         self.selected_file = None
         self.current_dir = '<0-d.idx>'
 
-        hotendTemp = self.printer.hotend
-        if hotendTemp is None:
-            hotendTemp = 0
-
-        self.send_line("A0V", str(hotendTemp))
+        self.send_raw(self.poll_cache['A0'])
 
     # A1
     def _GetHotEndTargetTemp(self):
-        hotendtargetTemp = self.printer.hotend_target
-        if hotendtargetTemp is None:
-            hotendtargetTemp = 0
-
-        self.send_line("A1V", str(hotendtargetTemp))
+        self.send_raw(self.poll_cache['A1'])
 
     # A2
     def _GetHeatBedTemp(self):
-        heatBedTemp = self.printer.bed
-        if heatBedTemp is None:
-            heatBedTemp = 0
-
-        self.send_line("A2V", str(heatBedTemp))
+        self.send_raw(self.poll_cache['A2'])
 
     # A3
     def _GetHeatBedTargetTemp(self):
-        heatBedTargetTemp = self.printer.bed_target
-        if heatBedTargetTemp is None:
-            heatBedTargetTemp = 0
-
-        self.send_line("A3V", str(heatBedTargetTemp))
+        self.send_raw(self.poll_cache['A3'])
 
     # A4
     def _GetPartFanSpeed(self):
-        partFanSpeed = self.printer.fan
-        if partFanSpeed is None:
-            partFanSpeed = 0
-
-        self.send_line("A4V", str(partFanSpeed))
+        self.send_raw(self.poll_cache['A4'])
 
     # A5
     def _GetCurrentPos(self):
-        currentXPos = self.printer.x_pos
-        currentYPos = self.printer.y_pos
-        currentZPos = self.printer.z_pos
-
-        if self.printer.x_pos is None:
-            currentXPos = 0.0
-        if self.printer.y_pos is None:
-            currentYPos = 0.0
-        if self.printer.z_pos is None:
-            currentZPos = 0.0
-
-        self.send_line("A5V X:", str(currentXPos), "Y:", str(currentYPos), "Z:", str(currentZPos))
+        self.send_raw(self.poll_cache['A5'])
 
     # A6
     def _GetProgress(self):
-        progress = self.printer.percent
-
-        if self.printer.percent is None:
-            progress = 0.0
-
-        self.send_line("A6V", str(progress))
+        self.send_raw(self.poll_cache['A6'])
 
     # A7
     def _GetPrintingTime(self):
-        printingTime = self.printer.print_time
-
-        if self.printer.print_time is None:
-            printingTime = 0.0
-
-        hours, minutes = self.convert_seconds_to_time(printingTime)
-
-        self.send_line("A7V", str(hours),"H", str(minutes),"M")
+        self.send_raw(self.poll_cache['A7'])
 
     # A8
     def _GetGcodeFileList(self, s_param):
         files = self.callback(self.evt.FILES)
         current_dir = self.current_dir
-        file_dict = self.file_dict
 
-        if files != self.files:
-            print("Reset files")
+        if files is not self.files:
+            logger.debug("file list changed, rebuilding folders")
             self.files = files
-            print(files)
-            file_dict = self._CreateFileDict(self.files)
+            self._CreateFileDict(self.files)
 
-        self._RenderView(file_dict, current_dir, s_param)
+        self._RenderView(current_dir, s_param)
 
     # A9
     def _PausePrint(self):
@@ -479,19 +839,6 @@ class LCD:
 
     # A13
     def _SelectFile(self, alt_name):
-
-        def find_parent_alt_name(data, target_alt_name, parent_alt_name=None):
-            for key, value in data.items():
-                if value.get('alt_name') == target_alt_name:
-                    if not parent_alt_name:
-                        break
-                    return parent_alt_name
-                if value.get('type') == 'dir' and 'files' in value:
-                    result = find_parent_alt_name(value['files'], target_alt_name, value.get('alt_name'))
-                    if result:
-                        return result
-            return '<0-d.idx>'
-
         if 'd.idx' in alt_name: # check for dir
             new_dir = alt_name
             file_dict = self.file_dict
@@ -505,7 +852,7 @@ class LCD:
 
             if alt_name == '<back-d.idx>':
                 # set new_dir to parent
-                self.current_dir = find_parent_alt_name(self.file_dict, self.current_dir)
+                self.current_dir = self.parent_alt_names.get(self.current_dir, '<0-d.idx>')
 
             else:
                 # set new_dir as self.current_dir
@@ -531,20 +878,22 @@ class LCD:
 
     # A16
     def _SetHotEndTemp(self, data):
-        print(data)
         self.printer.hotend_target = data
+        self._update_poll_cache()
 
         self.callback(self.evt.NOZZLE, self.printer.hotend_target)
 
     # A17
     def _SetHeatBedTemp(self, data):
         self.printer.bed_target = data
+        self._update_poll_cache()
 
         self.callback(self.evt.BED, self.printer.bed_target)
 
     # A18
     def _SetFanSpeed(self, data):
         self.printer.fan = data
+        self._update_poll_cache()
 
         self.callback(self.evt.FAN, self.printer.fan)
 
@@ -557,15 +906,11 @@ class LCD:
     def _GetSetPrintingSpeed(self, data=None):
 
         if data is None:
-            printingSpeed = self.printer.feedrate
-
-            if self.printer.feedrate is None:
-                printingSpeed = 0.0
-
-            self.send_line("A20V", str(printingSpeed))
+            self.send_raw(self.poll_cache['A20'])
 
         else:
             self.printer.feedrate = data
+            self._update_poll_cache()
             self.callback(self.evt.PRINT_SPEED, self.printer.feedrate)
 
     # A21
@@ -608,10 +953,9 @@ class LCD:
     # A26
     def _RefreshFileList(self):
         current_dir = self.current_dir
-        file_dict = self.file_dict
 
         try:
-            self._RenderView(file_dict, current_dir)
+            self._RenderView(current_dir)
         except NameError:
             # Fetch files if variable is empty
             self.files = self.callback(self.evt.FILES)
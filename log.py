@@ -0,0 +1,182 @@
+import atexit
+import collections
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+ROOT = 'klippertft'
+LOG_FORMAT = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+LOG_QUEUE_SIZE = 4096
+LOG_FILE_BYTES = 1024 * 1024
+LOG_FILE_BACKUPS = 3
+RING_SIZE = 2000
+TRACE_FILE = '/tmp/KlipperTFT-trace.log'
+
+
+def get(subsystem):
+    # Subsystems: lcd, lcd.rx, lcd.tx, printer, klippy, moonraker, main, ...
+    return logging.getLogger(ROOT + '.' + subsystem)
+
+
+def to_level(level):
+    # Name or number, an unknown name falls back to INFO
+    if isinstance(level, int):
+        return level
+    level = str(level).strip().upper()
+    if level.isdigit():
+        return int(level)
+    value = logging.getLevelName(level)
+    if not isinstance(value, int):
+        sys.stderr.write("unknown log level %r, using INFO\n" % level)
+        return logging.INFO
+    return value
+
+
+def parse_levels(spec):
+    # "lcd.tx=DEBUG,klippy=WARNING" -> {'lcd.tx': 10, 'klippy': 30}
+    levels = {}
+    for item in (spec or '').split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = to_level(level)
+    return levels
+
+
+class RingBufferHandler(logging.Handler):
+    # Keeps the last records unformatted, they are only formatted on dump
+    def __init__(self, capacity=RING_SIZE):
+        super().__init__()
+        self.records = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def dump(self, stream):
+        for record in list(self.records):
+            stream.write(self.format(record) + '\n')
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    # Hands records to the writer thread as they are, so the message is
+    # formatted there, and drops them when the writer cannot keep up
+    def __init__(self, q, levels, default):
+        super().__init__(q)
+        self.levels = levels
+        self.default = default
+        self.thresholds = {}
+        self.dropped = 0
+
+    def threshold(self, name):
+        level = self.thresholds.get(name)
+        if level is None:
+            level = self.default
+            subsystem = name[len(ROOT) + 1:]
+            # Longest configured prefix wins, lcd.tx before lcd
+            for key in sorted(self.levels, key=len, reverse=True):
+                if subsystem == key or subsystem.startswith(key + '.'):
+                    level = self.levels[key]
+                    break
+            self.thresholds[name] = level
+        return level
+
+    def handle(self, record):
+        if record.levelno < self.threshold(record.name):
+            return False
+        return super().handle(record)
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room, everything queued before it is still written
+        self.queue.put(self._sentinel)
+
+
+class Logging:
+    def __init__(self):
+        self.listener = None
+        self.queue_handler = None
+        self.ring = None
+
+    def configure(self, level='INFO', levels=None, ring_level=None, ring_size=RING_SIZE,
+                  filename=None, stream=None):
+        # level/levels gate what is written, ring_level what the ring keeps,
+        # by default the same level. Loggers are set to the lower of both,
+        # so anything below is dropped at the call site before a record is
+        # even created. ring_size=0 turns the ring off.
+        default = to_level(level)
+        levels = levels or {}
+        ring_threshold = default if ring_level is None else to_level(ring_level)
+
+        formatter = logging.Formatter(LOG_FORMAT)
+        if filename:
+            output = logging.handlers.RotatingFileHandler(filename, maxBytes=LOG_FILE_BYTES,
+                                                          backupCount=LOG_FILE_BACKUPS)
+        else:
+            output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(formatter)
+
+        q = queue.Queue(LOG_QUEUE_SIZE)
+        self.queue_handler = NonBlockingQueueHandler(q, levels, default)
+        self.listener = DrainingQueueListener(q, output)
+        self.listener.start()
+        atexit.register(self.stop)
+
+        root = logging.getLogger(ROOT)
+        root.propagate = False
+        root.addHandler(self.queue_handler)
+        if ring_size:
+            self.ring = RingBufferHandler(ring_size)
+            self.ring.setFormatter(formatter)
+            self.ring.setLevel(ring_threshold)
+            root.addHandler(self.ring)
+        # Subsystem levels are set on their own loggers, a DEBUG override
+        # must not enable debug records everywhere else
+        root.setLevel(min(default, ring_threshold) if self.ring else default)
+        for name, value in levels.items():
+            get(name).setLevel(min(value, ring_threshold) if self.ring else value)
+
+    def dump(self, filename=TRACE_FILE):
+        # Writes the ring buffer, e.g. from a SIGUSR1 handler
+        if self.ring is None:
+            return None
+        with open(filename, 'w') as f:
+            f.write('# trace dump %s, %d records\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), len(self.ring.records)))
+            self.ring.dump(f)
+        return filename
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+
+LOGGING = Logging()
+
+
+def configure_from_env(environ=os.environ):
+    # KLIPPERTFT_LOG_LEVEL=INFO, KLIPPERTFT_LOG_LEVELS=lcd.tx=DEBUG,klippy=WARNING,
+    # KLIPPERTFT_LOG_FILE=/tmp/KlipperTFT.log, KLIPPERTFT_LOG_RING=DEBUG (or OFF,
+    # unset keeps the ring at the log level)
+    ring = environ.get('KLIPPERTFT_LOG_RING')
+    off = ring is not None and ring.strip().upper() == 'OFF'
+    LOGGING.configure(level=environ.get('KLIPPERTFT_LOG_LEVEL', 'INFO'),
+                      levels=parse_levels(environ.get('KLIPPERTFT_LOG_LEVELS')),
+                      ring_level=None if off else ring,
+                      ring_size=0 if off else RING_SIZE,
+                      filename=environ.get('KLIPPERTFT_LOG_FILE'))
+
+
+def dump():
+    return LOGGING.dump()
@@ -1,38 +1,153 @@
 import getopt
 import sys
 import time
-import base64
 import os
+import signal
 from threading import Thread
 
-from printer import PrinterData
+from printer import PrinterData, InputCoalescer
 from lcd import LCD, _printerData
+from metrics import MetricsExporter
+from snapshot import StateSnapshot
+from util import cache_path
+import log
+
+logger = log.get('main')
 
 class KlipperLCD ():
-    def __init__(self):
-        self.lcd = LCD("/dev/ttyAMA0", callback=self.lcd_callback)
-        self.lcd.start()
-        self.printer = PrinterData('XXXXXX', URL=("127.0.0.1"), callback=self.printer_callback)
+    def __init__(self, lcd_port="/dev/ttyAMA0", moonraker_url="127.0.0.1", moonraker_port=80,
+                 metrics_file=None, metrics_socket=None, runtime=None):
+        # With a runtime (see runtime.py) the serial port and sockets are
+        # served by its event loop and this object lives on its app thread
+        self.runtime = runtime
+        loop = runtime.loop if runtime else None
+        self.created = time.monotonic()
+        # Set once the printer is discovered, until then the TFT gets the
+        # placeholder state and its other commands are ignored
+        self.ready = False
+        # Prometheus text to a file and/or a unix socket, plus a summary line
+        self.metrics = MetricsExporter(path=metrics_file, socket_path=metrics_socket)
+        self.metrics.start()
+        self.lcd = LCD(lcd_port, callback=self.lcd_callback)
+        self.lcd.start(loop, runtime.submit if runtime else None)
+        self.printer = PrinterData('XXXXXX', URL=moonraker_url, callback=self.printer_callback,
+                                   port=moonraker_port, gcode_transport='klippy',
+                                   loop=loop, dispatch=runtime.submit_status if runtime else None)
+        self.input = InputCoalescer(self.printer, call_later=runtime.call_later if runtime else None)
+        # Setpoints the TFT already shows are kept until the printer is ready
+        self.input.hold()
+        # Warm start: what the last run knew is served until discovery is done
+        self.snapshot = StateSnapshot(cache_path('state.json'),
+                                      call_later=runtime.call_later if runtime else None)
+        # The file list is large and changes rarely, it is written as its own
+        # part and only when the index changed, not with every status change
+        self.files_snapshot = StateSnapshot(cache_path('files.json'),
+                                            call_later=runtime.call_later if runtime else None)
+        sections = self.snapshot.load(self.printer.op.base_address)
+        sections.update(self.files_snapshot.load(self.printer.op.base_address))
+        self.restore(sections)
+        self.files_version = self.printer.file_index.version if 'files' in sections else None
         self.running = False
         self.wait_probe = False
-        self.thumbnail_inprogress = False
+        self.files_loading = False
+        self.coalesced_events = (self.lcd.evt.MOVE, self.lcd.evt.NOZZLE, self.lcd.evt.BED,
+                                 self.lcd.evt.FAN, self.lcd.evt.PRINT_SPEED)
+        self.setpoints = {
+            self.lcd.evt.NOZZLE: ('nozzle', self.printer.setExtTemp),
+            self.lcd.evt.BED: ('bed', self.printer.setBedTemp),
+            self.lcd.evt.FAN: ('fan', self.printer.set_fan),
+            self.lcd.evt.PRINT_SPEED: ('speed', self.printer.set_print_speed),
+        }
+        logger.info("lcd up after %.0f ms", (time.monotonic() - self.created) * 1000)
 
-        self.printer.init_Webservices()
+    def start(self):
+        logger.info("KlipperLCD start")
+        self.running = True
+        #self.lcd.start()
+        self.background(self.bring_up)
+
+    def bring_up(self):
+        timings = self.printer.start()
 
 #        macros = self.printer.get_macros()
 #        self.lcd.write_macros(macros)
 
-        print(self.printer.MACHINE_SIZE)
-        print(self.printer.SHORT_BUILD_VERSION)
+        logger.info("machine size %s, Klipper %s", self.printer.MACHINE_SIZE, self.printer.SHORT_BUILD_VERSION)
+        logger.info("startup took %.0f ms: %s", (time.monotonic() - self.created) * 1000,
+                    ", ".join("%s %.0f ms" % (name, seconds * 1000) for name, seconds in timings))
+        self.ready = True
+        if self.runtime is None:
+            self.input.release()
+            self.periodic_update()
+        else:
+            self.runtime.submit(self.input.release)
+            self.printer.status_event.set()
+            self.runtime.submit(self.runtime.refresh_soon)
 
-    def start(self):
-        print("KlipperLCD start")
-        self.running = True
-        #self.lcd.start()
-        Thread(target=self.periodic_update).start()
+    def restore(self, sections):
+        if 'printer' in sections:
+            self.printer.restore_state(sections['printer'], sections.get('files'))
+        state = sections.get('lcd')
+        if state and state.get('hotend') is not None:
+            data = _printerData()
+            for name, value in state.items():
+                if hasattr(_printerData, name):
+                    setattr(data, name, value)
+            self.lcd.data_update(data)
+
+    def save_snapshot(self, data):
+        self.snapshot.update('printer', self.printer.snapshot_state())
+        index = self.printer.file_index
+        if index.loaded and index.version != self.files_version:
+            self.files_version = index.version
+            self.files_snapshot.update('files', index.snapshot()[0])
+        # A copy, data is changed later by the setpoint handlers
+        self.snapshot.update('lcd', dict(vars(data)))
+
+    def background(self, fn, *args):
+        if self.runtime is None:
+            Thread(target=fn, args=args).start()
+        else:
+            self.runtime.background(fn, *args)
+
+    def refresh(self):
+        # After a change the TFT shows. The runtime's app thread also
+        # answers the polls, so it never waits for a Moonraker query.
+        if self.runtime is None:
+            self.update()
+        else:
+            self.runtime.refresh_soon()
+
+    def files(self):
+        if self.runtime is None:
+            return self.printer.GetFiles(True)
+        # The listing is read on the io pool, the TFT gets it with its next
+        # A8 and the current one until then
+        if self.printer.files_stale(True) and not self.files_loading:
+            self.files_loading = True
+            self.runtime.fetch(self.read_files, self.files_read)
+        return self.printer.listed_files()
+
+    def read_files(self):
+        try:
+            return self.printer.list_files()
+        except Exception as e:
+            logger.error("file list read failed: %s", e)
+            return None
+
+    def files_read(self, files):
+        self.files_loading = False
+        if files is not None:
+            self.printer.load_files(files)
+
+    def probe_calibrate(self):
+        if self.runtime is None or self.printer.homed():
+            self.printer.probe_calibrate()
+        else:
+            self.runtime.fetch(self.printer.query_homed, self.printer.probe_calibrate)
 
-    def update(self):
-        self.printer.update_variable()
+    def update(self, data=None):
+        self.printer.update_variable(data)
         data = _printerData()
         data.hotend_target = self.printer.thermalManager['temp_hotend'][0]['target']
         data.hotend        = self.printer.thermalManager['temp_hotend'][0]['celsius']
@@ -59,23 +174,45 @@ class KlipperLCD ():
         data.square_corner_velocity = self.printer.square_corner_velocity
 
         self.lcd.data_update(data)
+        self.save_snapshot(data)
 
     def periodic_update(self):
+        # Wake up as soon as the Klippy subscription delivers a change,
+        # the timeout keeps the Moonraker fallback polling going.
         while self.running:
             self.update()
-            time.sleep(2)
+            self.printer.status_event.wait(2)
+            self.printer.status_event.clear()
 
     def printer_callback(self, data, data_type):
         # Currently not used
-        print("Printer callback")
-
+        logger.debug("printer callback %s", data_type)
 
     def lcd_callback(self, evt, data=None):
-        print("callback")
+        logger.debug("lcd event %d %r", evt, data)
+        if not self.ready:
+            if evt == self.lcd.evt.FILES:
+                # The listing restored from the snapshot, if any
+                return self.printer.listed_files()
+            if evt in self.setpoints:
+                # The TFT shows the new value already, it is sent once ready
+                logger.info("printer not ready, holding lcd event %d", evt)
+                key, func = self.setpoints[evt]
+                self.input.setpoint(key, func, data)
+                return None
+            logger.info("printer not ready, ignoring lcd event %d", evt)
+            return None
+        # Jogs and setpoints are coalesced, stop and motor off drop pending
+        # moves, everything else has to go out after what is pending.
+        if evt == self.lcd.evt.PRINT_STOP or evt == self.lcd.evt.MOTOR_OFF:
+            self.input.flush(moves=False)
+        elif evt not in self.coalesced_events:
+            self.input.flush()
+
         if evt == self.lcd.evt.HOME:
             self.printer.home(data)
         elif evt == self.lcd.evt.MOVE:
-            self.printer.moveRelative(data[0], data[1], data[2])
+            self.input.move(data[0], data[1], data[2])
         elif evt == self.lcd.evt.MOVE_X:
             self.printer.moveRelative('X', data, 4000)
         elif evt == self.lcd.evt.MOVE_Y:
@@ -83,25 +220,21 @@ class KlipperLCD ():
         elif evt == self.lcd.evt.MOVE_Z:
             self.printer.moveRelative('Z', data, 600)
         elif evt == self.lcd.evt.MOVE_E:
-            print(data)
             self.printer.moveRelative('E', data[0], data[1])
         elif evt == self.lcd.evt.Z_OFFSET:
             self.printer.setZOffset(data)
-        elif evt == self.lcd.evt.NOZZLE:
-            self.printer.setExtTemp(data)
-        elif evt == self.lcd.evt.BED:
-            self.printer.setBedTemp(data)
+        elif evt in self.setpoints:
+            key, func = self.setpoints[evt]
+            self.input.setpoint(key, func, data)
         elif evt == self.lcd.evt.FILES:
-            files = self.printer.GetFiles(True)
-            return files
+            return self.files()
+        elif evt == self.lcd.evt.METADATA:
+            self.printer.prefetch_metadata(data)
         elif evt == self.lcd.evt.PRINT_START:
             self.printer.openAndPrintFile(data)
-            if self.thumbnail_inprogress == False:
-                self.thumbnail_inprogress = True
         elif evt == self.lcd.evt.THUMBNAIL:
-            if self.thumbnail_inprogress == False:
-                self.thumbnail_inprogress = True
-                Thread(target=self.show_thumbnail).start()
+            # The TFT cannot show images, see thumbnail.py
+            pass
         elif evt == self.lcd.evt.PRINT_STATUS:
             pass
         elif evt == self.lcd.evt.PRINT_STOP:
@@ -110,23 +243,21 @@ class KlipperLCD ():
             self.printer.pause_job()
         elif evt == self.lcd.evt.PRINT_RESUME:
             self.printer.resume_job()
-        elif evt == self.lcd.evt.PRINT_SPEED:
-            self.printer.set_print_speed(data)
         elif evt == self.lcd.evt.FLOW:
             self.printer.set_flow(data)
         elif evt == self.lcd.evt.PROBE:
             if data == None:
-                self.printer.probe_calibrate()
+                self.probe_calibrate()
                 self.wait_probe = True
             else:
                 self.printer.probe_adjust(data)
-                self.update()
+                self.refresh()
         elif evt == self.lcd.evt.PROBE_COMPLETE:
             self.wait_probe = False
-            print("Save settings!")
+            logger.info("probe complete, saving")
             self.printer.sendGCode('ACCEPT')
             self.printer.sendGCode('G1 F1000 Z15.0')
-            print("Calibrate!")
+            logger.info("calibrating bed mesh")
             # data.hotend        = self.printer.thermalManager['temp_hotend'][0]['celsius']
             # data.bed           = self.printer.thermalManager['temp_bed']['celsius']
             self.lcd.write("pretemp.nozzle.txt=\"%d\"" % self.printer.thermalManager['temp_hotend'][0]['target'])
@@ -140,7 +271,7 @@ class KlipperLCD ():
             self.printer.sendGCode('G28 Z')
             self.printer.probe_calibrate()
         elif evt == self.lcd.evt.PROBE_BACK:
-            print("BACK!")
+            logger.info("probe back, saving config")
             self.printer.sendGCode('ACCEPT')
             self.printer.sendGCode('G1 F1000 Z15.0')
             self.printer.sendGCode('SAVE_CONFIG')
@@ -148,27 +279,36 @@ class KlipperLCD ():
             pass
         elif evt == self.lcd.evt.LIGHT:
             self.printer.set_led(data)
-        elif evt == self.lcd.evt.FAN:
-            self.printer.set_fan(data)
         elif evt == self.lcd.evt.MOTOR_OFF:
             self.printer.sendGCode('M18')
         elif evt == self.lcd.evt.ACCEL:
             self.printer.sendGCode("SET_VELOCITY_LIMIT ACCEL=%d" % data)
-            self.update()
+            self.refresh()
         elif evt == self.lcd.evt.MIN_CRUISE_RATIO:
             self.printer.sendGCode("SET_VELOCITY_LIMIT MINIMUM_CRUISE_RATIO=%.2f" % data)
-            self.update()
+            self.refresh()
         elif evt == self.lcd.evt.VELOCITY:
             self.printer.sendGCode("SET_VELOCITY_LIMIT VELOCITY=%d" % data)
-            self.update()
+            self.refresh()
         elif evt == self.lcd.evt.SQUARE_CORNER_VELOCITY:
             self.printer.sendGCode("SET_VELOCITY_LIMIT SQUARE_CORNER_VELOCITY=%.1f" % data)
-            self.update()
+            self.refresh()
         elif evt == self.lcd.evt.CONSOLE:
             self.printer.sendGCode(data)
         else:
-            print("lcd_callback event not recognised %d" % evt)
+            logger.warning("lcd_callback event not recognised %d", evt)
 
 if __name__ == "__main__":
-    x = KlipperLCD()
-    x.start()
+    log.configure_from_env()
+    # kill -USR1 <pid> writes the debug ring buffer to log.TRACE_FILE
+    signal.signal(signal.SIGUSR1, lambda signum, frame: log.dump())
+    # --asyncio serves the TFT and the sockets from one event loop
+    opts, args = getopt.getopt(sys.argv[1:], "", ["asyncio"])
+    options = dict(metrics_file=os.environ.get("KLIPPERTFT_METRICS_FILE"),
+                   metrics_socket=os.environ.get("KLIPPERTFT_METRICS_SOCKET"))
+    if ("--asyncio", "") in opts:
+        from runtime import Runtime
+        Runtime().run(lambda runtime: KlipperLCD(runtime=runtime, **options))
+    else:
+        x = KlipperLCD(**options)
+        x.start()
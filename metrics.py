@@ -0,0 +1,267 @@
+import bisect
+import os
+import socket
+import threading
+import time
+
+import log
+
+logger = log.get('metrics')
+
+# Upper bounds in seconds / bytes, memory per metric is fixed by these
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 4096, 16384, 65536)
+
+EXPORT_INTERVAL = 10.0
+SUMMARY_INTERVAL = 60.0
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', (), self.value)]
+
+
+class Gauge:
+    # Reads its value from a callback at export time
+    kind = 'gauge'
+
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.fn is None:
+            return self.value
+        try:
+            return self.fn()
+        except Exception:
+            return float('nan')
+
+    def samples(self):
+        return [('', (), self.get())]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+    def samples(self):
+        counts, total, count = self.snapshot()
+        out = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            out.append(('_bucket', (('le', repr(float(bound))),), cumulative))
+        out.append(('_bucket', (('le', '+Inf'),), count))
+        out.append(('_sum', (), total))
+        out.append(('_count', (), count))
+        return out
+
+
+def quantile(buckets, counts, q):
+    # Upper bound of the bucket holding the q-quantile, None without samples
+    count = sum(counts)
+    if not count:
+        return None
+    rank = q * count
+    cumulative = 0
+    for i, n in enumerate(counts):
+        cumulative += n
+        if cumulative >= rank:
+            return buckets[i] if i < len(buckets) else float('inf')
+    return float('inf')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    escaped = ('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}
+        self.last = {}
+
+    def _get(self, cls, name, help, labels, *args):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = (cls.kind, help, {})
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = cls(*args)
+            return metric
+
+    def counter(self, name, help, **labels):
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def gauge(self, name, help, fn=None, **labels):
+        # A gauge registered again (e.g. after a reconnect) reads the new fn
+        metric = self._get(Gauge, name, help, labels, fn)
+        metric.fn = fn
+        return metric
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            families = [(name, kind, help, list(metrics.items()))
+                        for name, (kind, help, metrics) in sorted(self.families.items())]
+        for name, kind, help, metrics in families:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for key, metric in metrics:
+                for suffix, extra, value in metric.samples():
+                    lines.append('%s%s%s %s' % (name, suffix, _labels(key + extra), value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        # One line with what happened since the previous summary
+        parts = []
+        with self.lock:
+            families = [(name, kind, list(metrics.items()))
+                        for name, (kind, _, metrics) in sorted(self.families.items())]
+        for name, kind, metrics in families:
+            short = name[len('klippertft_'):] if name.startswith('klippertft_') else name
+            if kind == 'histogram':
+                buckets = None
+                delta = None
+                for key, metric in metrics:
+                    counts, _, _ = metric.snapshot()
+                    last = self.last.get((name, key), [0] * len(counts))
+                    self.last[(name, key)] = counts
+                    diff = [a - b for a, b in zip(counts, last)]
+                    delta = diff if delta is None else [a + b for a, b in zip(delta, diff)]
+                    buckets = metric.buckets
+                n = sum(delta) if delta else 0
+                if n:
+                    p99 = quantile(buckets, delta, 0.99)
+                    parts.append('%s n=%d p50<=%g p99<=%g' % (short, n, quantile(buckets, delta, 0.5), p99))
+            elif kind == 'counter':
+                total = 0
+                for key, metric in metrics:
+                    value = metric.value
+                    total += value - self.last.get((name, key), 0)
+                    self.last[(name, key)] = value
+                if total:
+                    parts.append('%s +%d' % (short, total))
+            else:
+                total = sum(metric.get() for _, metric in metrics)
+                parts.append('%s=%g' % (short, total))
+        return 'metrics: ' + ('; '.join(parts) if parts else 'idle')
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, **labels):
+    return REGISTRY.counter(name, help, **labels)
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS, **labels):
+    return REGISTRY.histogram(name, help, buckets, **labels)
+
+
+def gauge(name, help, fn=None, **labels):
+    return REGISTRY.gauge(name, help, fn, **labels)
+
+
+class MetricsExporter:
+    # Writes the registry to a file (atomically replaced) and/or serves it
+    # on a unix socket, one scrape per connection, and logs a summary line
+    def __init__(self, registry=REGISTRY, path=None, socket_path=None,
+                 interval=EXPORT_INTERVAL, summary_interval=SUMMARY_INTERVAL):
+        self.registry = registry
+        self.path = path
+        self.socket_path = socket_path
+        self.interval = interval
+        self.summary_interval = summary_interval
+        self.stopped = threading.Event()
+        self.server = None
+
+    def start(self):
+        if self.socket_path:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(self.socket_path)
+            self.server.listen(4)
+            threading.Thread(target=self.serve, name="metrics-socket", daemon=True).start()
+        threading.Thread(target=self.run, name="metrics", daemon=True).start()
+
+    def write_file(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.registry.render())
+        os.replace(tmp, self.path)
+
+    def serve(self):
+        while not self.stopped.is_set():
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            try:
+                conn.sendall(self.registry.render().encode('utf-8'))
+            except OSError:
+                pass
+            finally:
+                conn.close()
+
+    def run(self):
+        next_summary = time.monotonic() + self.summary_interval
+        while not self.stopped.wait(self.interval):
+            if self.path:
+                try:
+                    self.write_file()
+                except OSError as e:
+                    logger.error("export to %s failed: %s", self.path, e)
+            if time.monotonic() >= next_summary:
+                logger.info("%s", self.registry.summary())
+                next_summary += self.summary_interval
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
@@ -1,4 +1,4 @@
-from asyncio.tasks import sleep
+import asyncio
 import threading
 import errno
 import select
@@ -9,8 +9,36 @@ from requests.exceptions import ConnectionError
 from json import JSONDecodeError
 import atexit
 import time
-import asyncio
 import os
+import queue
+import contextlib
+import collections
+import random
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import quote
+
+import log
+import metrics
+from util import cache_path, start_timer
+
+logger = log.get('printer')
+klippy_log = log.get('klippy')
+moonraker_log = log.get('moonraker')
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+# Fast JSON backend for the socket traffic, orjson when available
+if orjson is not None:
+	json_loads = orjson.loads
+	json_dumps = orjson.dumps
+else:
+	def json_loads(data):
+		return json.loads(data.decode('utf-8'))
+	def json_dumps(obj):
+		return json.dumps(obj, separators=(',', ':')).encode()
 
 class xyze_t:
 	x = 0.0
@@ -87,93 +115,955 @@ class material_preset_t:
 		self.bed_temp = bed_temp
 		self.fan_speed = fan_speed
 
+# Maximum number of requests waiting to be sent on a Klippy socket
+KLIPPY_QUEUE_SIZE = 256
+KLIPPY_RECV_SIZE = 65536
+
+class KlippyError(Exception):
+	pass
+
+class KlippyConnectionError(KlippyError):
+	# The request never left, it is safe to retry it on another path
+	pass
+
+class MessageFramer:
+	# Splits the byte stream of a Klippy/Moonraker socket on ETX. Data is
+	# collected as bytes and only complete frames are handed out, so UTF-8
+	# characters split over two recv() calls survive and large payloads are
+	# not re-concatenated on every chunk.
+	def __init__(self):
+		self.buffer = bytearray()
+		self.scanned = 0
+
+	def feed(self, data):
+		buf = self.buffer
+		buf += data
+		idx = buf.find(b'\x03', self.scanned)
+		if idx < 0:
+			self.scanned = len(buf)
+			return []
+		frames = []
+		start = 0
+		with memoryview(buf) as view:
+			while idx >= 0:
+				if idx > start:
+					frames.append(bytes(view[start:idx]))
+				start = idx + 1
+				idx = buf.find(b'\x03', start)
+		del buf[:start]
+		self.scanned = len(buf)
+		return frames
+
 class KlippySocket:
-	def __init__(self, uds_filename, callback=None):
+	# With a loop the socket is served by that asyncio event loop (see
+	# runtime.py) instead of its own polling thread
+	# Connects once and raises KlippyConnectionError when that fails, see
+	# KlippySupervisor for retries. on_lost() is called when the connection
+	# drops, not on klippyExit(). The supervisor closes it at exit.
+	def __init__(self, uds_filename, callback=None, jsonrpc=False, loop=None, on_lost=None):
 		self.connected = False
+		self.jsonrpc = jsonrpc
+		self.loop = loop
+		self.on_lost = on_lost
 		self.webhook_socket_create(uds_filename)
 		self.lock = threading.Lock()
 		self.poll = select.poll()
 		self.stop_threads = False
+		self.closed = False
 		self.poll.register(self.webhook_socket, select.POLLIN | select.POLLHUP)
-		self.socket_data = ""
+		# Self-pipe to wake up the poller as soon as a line is queued
+		self.wakeup_r, self.wakeup_w = os.pipe()
+		os.set_blocking(self.wakeup_r, False)
+		os.set_blocking(self.wakeup_w, False)
+		self.poll.register(self.wakeup_r, select.POLLIN)
+		self.framer = MessageFramer()
+		self.recv_buffer = bytearray(KLIPPY_RECV_SIZE)
 		self.t = threading.Thread(target=self.polling)
 		self.callback = callback
-		self.lines = []
-		self.t.start()
-		atexit.register(self.klippyExit)
+		# Pre-encoded requests waiting to be sent and a partially sent rest
+		self.lines = collections.deque()
+		self.dropped_lines = 0
+		self.send_buffer = bytearray()
+		self.want_write = False
+		# Requests waiting for their response: id -> [future, method, sent, deadline]
+		self.next_id = 1
+		self.pending = {}
+		self.latency = {}
+		# Instrumentation, labelled by socket file (klippy.sock, moonraker.sock)
+		name = os.path.basename(uds_filename)
+		self.request_seconds = {}
+		self.metric_socket = name
+		self.metric_frames = metrics.counter('klippertft_klippy_frames_total', 'Messages received on the socket', socket=name)
+		self.metric_bytes = metrics.counter('klippertft_klippy_received_bytes_total', 'Bytes received on the socket', socket=name)
+		metrics.gauge('klippertft_klippy_send_backlog', 'Encoded messages waiting to be sent', lambda: len(self.lines), socket=name)
+		metrics.gauge('klippertft_klippy_pending_requests', 'Requests waiting for a response', lambda: len(self.pending), socket=name)
+		if loop is None:
+			self.t.start()
+		else:
+			loop.call_soon_threadsafe(self.attach)
 
 	def klippyExit(self):
-		print("Shuting down Klippy Socket")
+		if self.closed:
+			return
+		klippy_log.info("shutting down %s", self.metric_socket)
 		self.stop_threads = True
-		self.t.join()
+		if self.loop is None:
+			self.wakeup()
+			if threading.current_thread() is not self.t:
+				self.t.join()
+		self.closed = True
+		self.connected = False
+		if self.loop is not None and self.loop.is_running() and not self.on_loop():
+			# The loop owns the socket, let it close it
+			self.loop.call_soon_threadsafe(self.close_socket)
+		else:
+			self.close_socket()
+		self.fail_pending(KlippyError("socket closed"))
+
+	def close_socket(self):
+		if self.loop is not None and not self.loop.is_closed():
+			fd = self.webhook_socket.fileno()
+			if fd >= 0:
+				self.loop.remove_reader(fd)
+				self.loop.remove_writer(fd)
+		self.webhook_socket.close()
+		os.close(self.wakeup_r)
+		os.close(self.wakeup_w)
+
+	def on_loop(self):
+		try:
+			return asyncio.get_running_loop() is self.loop
+		except RuntimeError:
+			return False
 
 	def webhook_socket_create(self, uds_filename):
 		self.webhook_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 		self.webhook_socket.setblocking(0)
-		print("Waiting for connect to %s\n" % (uds_filename,))
-		while 1:
-			try:
-				self.webhook_socket.connect(uds_filename)
-			except socket.error as e:
-				if e.errno == errno.ECONNREFUSED:
-					time.sleep(0.1)
-					continue
-				print(
-					"Unable to connect socket %s [%d,%s]\n" % (
-						uds_filename, e.errno,
-						errno.errorcode[e.errno]
-					))
-				exit(-1)
-			break
-		print("Connection.\n")
+		try:
+			self.webhook_socket.connect(uds_filename)
+		except socket.error as e:
+			self.webhook_socket.close()
+			raise KlippyConnectionError("unable to connect socket %s [%s]" % (
+				uds_filename, errno.errorcode.get(e.errno, e.errno)))
+		klippy_log.info("connected to %s", uds_filename)
 		self.connected = True
 
 	def process_socket(self):
-		data = None
 		try:
-			data = self.webhook_socket.recv(4096).decode()
-		except:
-			pass
-		if not data:
+			size = self.webhook_socket.recv_into(self.recv_buffer)
+		except (BlockingIOError, InterruptedError):
+			return True
+		except OSError:
+			size = 0
+		if not size:
 			self.connected = False
-			print("Socket closed\n")
+			klippy_log.warning("%s closed", self.metric_socket)
 			return False
-		parts = data.split('\x03')
-		parts[0] = self.socket_data + parts[0]
-		self.socket_data = parts.pop()
-		for line in parts:
+		with memoryview(self.recv_buffer) as view:
+			frames = self.framer.feed(view[:size])
+		self.metric_bytes.inc(size)
+		if frames:
+			self.metric_frames.inc(len(frames))
+		for frame in frames:
+			try:
+				msg = json_loads(frame)
+			except ValueError:
+				klippy_log.error("unable to decode message on %s", self.metric_socket)
+				continue
+			if 'id' in msg and self.resolve(msg):
+				continue
 			if self.callback:
-				self.callback(line)
+				self.callback(msg)
+		return True
+
+	def request(self, method, params=None, timeout=None):
+		# Send a request with an allocated id. The returned future resolves
+		# to the 'result' of the response or fails with KlippyError or
+		# TimeoutError. Cancelling it drops the response.
+		future = Future()
+		now = time.monotonic()
+		with self.lock:
+			req_id = self.next_id
+			self.next_id += 1
+			deadline = now + timeout if timeout is not None else None
+			self.pending[req_id] = [future, method, now, deadline]
+		msg = {"id": req_id, "method": method, "params": params or {}}
+		if self.jsonrpc:
+			msg["jsonrpc"] = "2.0"
+		if self.closed or not self.connected or not self.queue_line(msg):
+			with self.lock:
+				self.pending.pop(req_id, None)
+			future.set_exception(KlippyConnectionError("unable to send %s" % method))
+		return future
+
+	def resolve(self, msg):
+		with self.lock:
+			entry = self.pending.pop(msg['id'], None)
+		if entry is None:
+			return False
+		future, method, sent, deadline = entry
+		elapsed = time.monotonic() - sent
+		stats = self.latency.setdefault(method, [0, 0.0, 0.0])
+		stats[0] += 1
+		stats[1] += elapsed
+		stats[2] = max(stats[2], elapsed)
+		histogram = self.request_seconds.get(method)
+		if histogram is None:
+			histogram = self.request_seconds[method] = metrics.histogram('klippertft_klippy_request_seconds',
+				'Socket request round trip', socket=self.metric_socket, method=method)
+		histogram.observe(elapsed)
+		if future.set_running_or_notify_cancel():
+			if 'error' in msg:
+				error = msg['error']
+				future.set_exception(KlippyError(error.get('message', error) if isinstance(error, dict) else error))
+			else:
+				future.set_result(msg.get('result'))
+		return True
+
+	def expire_pending(self):
+		now = time.monotonic()
+		expired = []
+		with self.lock:
+			for req_id, (future, method, sent, deadline) in list(self.pending.items()):
+				if future.cancelled():
+					del self.pending[req_id]
+				elif deadline is not None and now >= deadline:
+					del self.pending[req_id]
+					expired.append((future, method))
+		for future, method in expired:
+			if future.set_running_or_notify_cancel():
+				future.set_exception(TimeoutError("%s timed out" % method))
+
+	def fail_pending(self, error):
+		with self.lock:
+			pending = list(self.pending.values())
+			self.pending.clear()
+		for future, method, sent, deadline in pending:
+			if future.set_running_or_notify_cancel():
+				future.set_exception(error)
+
+	def latency_stats(self):
+		stats = {}
+		for method, (count, total, worst) in list(self.latency.items()):
+			stats[method] = {'count': count, 'avg': total / count, 'max': worst}
+		return stats
 
 	def queue_line(self, line):
+		if isinstance(line, dict):
+			data = json_dumps(line)
+		else:
+			line = line.strip()
+			if not line or line.startswith('#'):
+				return False
+			data = line.encode()
+		with self.lock:
+			if len(self.lines) >= KLIPPY_QUEUE_SIZE:
+				self.dropped_lines += 1
+				klippy_log.error("send queue of %s full, dropping request", self.metric_socket)
+				return False
+			self.lines.append(data + b'\x03')
+		self.wakeup()
+		return True
+
+	def wakeup(self):
+		if self.loop is not None:
+			try:
+				self.loop.call_soon_threadsafe(self.loop_send)
+			except RuntimeError:
+				pass # Loop closed, shutting down
+			return
+		try:
+			os.write(self.wakeup_w, b'\x00')
+		except (BlockingIOError, OSError):
+			pass # Pipe already full, the poller is awake anyway
+
+	def send_lines(self):
 		with self.lock:
-			self.lines.append(line)
+			while self.lines:
+				self.send_buffer += self.lines.popleft()
+		while self.send_buffer:
+			try:
+				sent = self.webhook_socket.send(self.send_buffer)
+			except (BlockingIOError, InterruptedError):
+				break # EAGAIN, wait for POLLOUT
+			except OSError as e:
+				klippy_log.error("send on %s failed [%s]", self.metric_socket, e)
+				self.connected = False
+				return False
+			del self.send_buffer[:sent]
+		want_write = len(self.send_buffer) > 0
+		if want_write != self.want_write:
+			if self.loop is not None:
+				if want_write:
+					self.loop.add_writer(self.webhook_socket.fileno(), self.loop_send)
+				else:
+					self.loop.remove_writer(self.webhook_socket.fileno())
+			else:
+				events = select.POLLIN | select.POLLHUP
+				if want_write:
+					events |= select.POLLOUT
+				self.poll.modify(self.webhook_socket, events)
+			self.want_write = want_write
+		return True
 
-	def send_line(self):
-		if len(self.lines) == 0:
+	def polling(self):
+		while not self.stop_threads:
+			# Wake up often enough to expire requests waiting for a response
+			res = self.poll.poll(100. if self.pending else 1000.)
+			for fd, event in res:
+				if fd == self.wakeup_r:
+					try:
+						while os.read(self.wakeup_r, 512):
+							pass
+					except BlockingIOError:
+						pass
+				elif event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+					if self.process_socket() is False:
+						self.dropped()
+						return
+			if self.stop_threads:
+				break
+			if self.send_lines() is False:
+				self.dropped()
+				return
+			if self.pending:
+				self.expire_pending()
+
+	# Event loop counterparts of polling(), all called on the loop
+	def attach(self):
+		if self.closed:
 			return
-		line = self.lines.pop(0).strip()
-		if not line or line.startswith('#'):
+		self.loop.add_reader(self.webhook_socket.fileno(), self.loop_receive)
+		self.loop_send()
+		self.loop_expire()
+
+	def loop_receive(self):
+		if not self.closed and self.process_socket() is False:
+			self.lost()
+
+	def loop_send(self):
+		if not self.closed and self.send_lines() is False:
+			self.lost()
+
+	def loop_expire(self):
+		if self.closed:
 			return
+		if self.pending:
+			self.expire_pending()
+		self.loop.call_later(0.1 if self.pending else 1.0, self.loop_expire)
+
+	def lost(self):
+		fd = self.webhook_socket.fileno()
+		self.loop.remove_reader(fd)
+		self.loop.remove_writer(fd)
+		self.dropped()
+
+	def dropped(self):
+		self.connected = False
+		self.fail_pending(KlippyError("socket closed"))
+		if self.on_lost is not None and not self.stop_threads:
+			self.on_lost()
+
+
+# Reconnect delays in seconds: doubled per failed attempt up to the maximum,
+# each one drawn from the upper half of that so clients do not retry in step
+RECONNECT_MIN = 0.25
+RECONNECT_MAX = 10.0
+# How often a live connection is checked when no loss was signalled
+SUPERVISOR_CHECK_INTERVAL = 5.0
+# A connection has to stay up this long before the backoff starts over, a
+# peer that accepts and drops right away is retried with growing delays
+RECONNECT_STABLE = 5.0
+
+class KlippySupervisor:
+	# Keeps a KlippySocket connected from its own thread, callers never wait
+	# for a connect. on_connect(sock) runs for every new connection to set
+	# up subscriptions again, on_disconnect() when one is lost. Stands in
+	# for the socket itself: connected, request() and klippyExit().
+	def __init__(self, uds_filename, callback=None, jsonrpc=False, loop=None,
+				 on_connect=None, on_disconnect=None):
+		self.uds_filename = uds_filename
+		self.callback = callback
+		self.jsonrpc = jsonrpc
+		self.loop = loop
+		self.on_connect = on_connect
+		self.on_disconnect = on_disconnect
+		self.sock = None
+		self.state = 'connecting'
+		self.attempts = 0
+		self.failures = 0
+		self.reconnects = 0
+		self.last_error = None
+		self.since = time.monotonic()
+		self.connected_since = None
+		self.wake = threading.Event()
+		self.stopped = threading.Event()
+		name = os.path.basename(uds_filename)
+		self.name = name
+		self.metric_reconnects = metrics.counter('klippertft_klippy_reconnects_total',
+			'Connections re-established after a loss', socket=name)
+		self.metric_failures = metrics.counter('klippertft_klippy_connect_failures_total',
+			'Failed connect attempts', socket=name)
+		metrics.gauge('klippertft_klippy_connected', 'Whether the socket is connected',
+			lambda: 1 if self.connected else 0, socket=name)
+		self.thread = threading.Thread(target=self.run, name="supervisor-%s" % name, daemon=True)
+		self.thread.start()
+		atexit.register(self.klippyExit)
+
+	@property
+	def connected(self):
+		sock = self.sock
+		return sock is not None and sock.connected
+
+	def request(self, method, params=None, timeout=None):
+		sock = self.sock
+		if sock is None:
+			future = Future()
+			future.set_exception(KlippyConnectionError("%s not connected" % self.name))
+			return future
+		return sock.request(method, params, timeout)
+
+	def stats(self):
+		return {
+			'state': self.state,
+			'connected': self.connected,
+			'attempts': self.attempts,
+			'failures': self.failures,
+			'reconnects': self.reconnects,
+			'last_error': self.last_error,
+			'state_seconds': time.monotonic() - self.since,
+		}
+
+	def set_state(self, state):
+		if state != self.state:
+			self.state = state
+			self.since = time.monotonic()
+
+	def backoff(self):
+		delay = min(RECONNECT_MAX, RECONNECT_MIN * 2 ** min(self.failures - 1, 16))
+		return random.uniform(delay / 2, delay)
+
+	def lost(self):
+		self.wake.set()
+
+	def run(self):
+		connected_before = False
+		while not self.stopped.is_set():
+			sock = self.sock
+			if sock is not None:
+				stable = time.monotonic() - self.connected_since >= RECONNECT_STABLE
+				if sock.connected:
+					if stable:
+						self.failures = 0
+					self.wake.wait(SUPERVISOR_CHECK_INTERVAL if stable else RECONNECT_STABLE)
+					self.wake.clear()
+					continue
+				self.sock = None
+				sock.klippyExit()
+				if stable:
+					self.failures = 0
+				self.failures += 1
+				delay = self.backoff()
+				klippy_log.warning("lost connection to %s, reconnecting in %.2f s", self.name, delay)
+				self.set_state('backoff')
+				if self.on_disconnect:
+					self.on_disconnect()
+				if self.stopped.wait(delay):
+					break
+				self.set_state('connecting')
+
+			self.attempts += 1
+			try:
+				sock = KlippySocket(self.uds_filename, callback=self.callback, jsonrpc=self.jsonrpc,
+					loop=self.loop, on_lost=self.lost)
+			except KlippyConnectionError as e:
+				self.failures += 1
+				self.metric_failures.inc()
+				self.last_error = str(e)
+				delay = self.backoff()
+				if self.failures == 1:
+					klippy_log.warning("%s, retrying", e)
+				else:
+					klippy_log.debug("%s, retry %d in %.2f s", e, self.failures, delay)
+				self.set_state('backoff')
+				self.stopped.wait(delay)
+				continue
+
+			if self.stopped.is_set():
+				sock.klippyExit()
+				break
+			if connected_before:
+				self.reconnects += 1
+				self.metric_reconnects.inc()
+			connected_before = True
+			if self.failures:
+				klippy_log.info("connected to %s after %d failed attempts", self.name, self.failures)
+			self.connected_since = time.monotonic()
+			self.sock = sock
+			self.set_state('connected')
+			if self.on_connect:
+				self.on_connect(sock)
+
+	def klippyExit(self):
+		if self.stopped.is_set():
+			return
+		self.stopped.set()
+		self.wake.set()
+		self.set_state('stopped')
+		sock = self.sock
+		if sock is not None:
+			sock.klippyExit()
+
+
+class FileIndex:
+	# In-memory index of the gcode files known to Moonraker. It is filled from
+	# one full /server/files/list and then kept current by applying the
+	# notify_filelist_changed events Moonraker sends on its unix socket.
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.entries = {}
+		self.loaded = False
+		self.version = 0
+		self.cached_version = -1
+		self.files = []
+		self.names = []
+
+	def load(self, files):
+		entries = {fl['path']: fl for fl in files}
+		with self.lock:
+			self.loaded = True
+			if entries != self.entries:
+				self.entries = entries
+				self.version += 1
+
+	def apply(self, action, item, source_item=None):
+		if item.get('root') != 'gcodes':
+			return
+		path = item['path']
+		with self.lock:
+			if action == 'create_file' or action == 'modify_file':
+				self.entries[path] = {k: v for k, v in item.items() if k != 'root'}
+			elif action == 'delete_file':
+				self.entries.pop(path, None)
+			elif action == 'move_file':
+				if source_item and source_item.get('root') == 'gcodes':
+					self.entries.pop(source_item['path'], None)
+				self.entries[path] = {k: v for k, v in item.items() if k != 'root'}
+			elif action == 'delete_dir':
+				prefix = path + '/'
+				self.entries = {p: fl for p, fl in self.entries.items() if not p.startswith(prefix)}
+			elif action == 'move_dir':
+				entries = self.entries
+				if source_item and source_item.get('root') == 'gcodes':
+					prefix = source_item['path'] + '/'
+					entries = {}
+					for p, fl in self.entries.items():
+						if p.startswith(prefix):
+							p = path + '/' + p[len(prefix):]
+							fl = dict(fl, path=p)
+						entries[p] = fl
+				self.entries = entries
+			elif action == 'root_update':
+				self.loaded = False
+				return
+			else:
+				# create_dir: empty folders are not listed
+				return
+			self.version += 1
+
+	def invalidate(self):
+		with self.lock:
+			self.loaded = False
+
+	def snapshot(self):
+		# Returns the (files, names) lists, the same objects while unchanged
+		with self.lock:
+			if self.cached_version != self.version:
+				self.files = list(self.entries.values())
+				self.names = [fl['path'] for fl in self.files]
+				self.cached_version = self.version
+			return self.files, self.names
+
+	def modified(self, path):
+		with self.lock:
+			entry = self.entries.get(path)
+		return entry.get('modified') if entry is not None else None
+
+
+METADATA_FIELDS = ('estimated_time', 'filament_total', 'filament_weight_total', 'filament_type',
+	'layer_height', 'first_layer_height', 'object_height', 'slicer', 'slicer_version')
+METADATA_TIMEOUT = (3.0, 10.0)
+
+class MetadataCache:
+	# Slicer metadata of the gcode files, keyed by path and modified time and
+	# persisted as JSON lines. A later line replaces an earlier one for the
+	# same path, a line without 'meta' drops it. The file is compacted once
+	# most of its lines are stale.
+	def __init__(self, filename):
+		self.filename = filename
+		self.lock = threading.Lock()
+		self.entries = {}
+		self.lines = 0
+		self.load()
+
+	def load(self):
 		try:
-			m = json.loads(line)
-		except JSONDecodeError:
-			print("ERROR: Unable to parse line\n")
+			with open(self.filename, 'rb') as f:
+				for line in f:
+					try:
+						record = json_loads(line)
+					except ValueError:
+						continue  # torn write at the end
+					self.lines += 1
+					if 'meta' in record:
+						self.entries[record['path']] = (record['modified'], record['meta'])
+					else:
+						self.entries.pop(record['path'], None)
+		except FileNotFoundError:
+			pass
+
+	def get(self, path, modified):
+		# modified None: a file not in the listing, nothing to validate against
+		with self.lock:
+			entry = self.entries.get(path)
+		if entry is None or (modified is not None and entry[0] != modified):
+			return None
+		return entry[1]
+
+	def put(self, path, modified, meta):
+		with self.lock:
+			self.entries[path] = (modified, meta)
+			self.append({'path': path, 'modified': modified, 'meta': meta})
+
+	def invalidate(self, path, prefix=False):
+		with self.lock:
+			if prefix:
+				paths = [p for p in self.entries if p.startswith(path + '/')]
+			else:
+				paths = [path] if path in self.entries else []
+			for p in paths:
+				del self.entries[p]
+				self.append({'path': p})
+
+	def retain(self, paths):
+		# Drop everything not in a freshly loaded listing
+		with self.lock:
+			stale = [p for p in self.entries if p not in paths]
+			for p in stale:
+				del self.entries[p]
+			if stale:
+				self.compact()
+
+	def apply(self, action, item, source_item=None):
+		# Mirrors FileIndex.apply for notify_filelist_changed events
+		if item.get('root') != 'gcodes':
 			return
-		cm = json.dumps(m, separators=(',', ':'))
-		wdm = '{}\x03'.format(cm)
-		self.webhook_socket.send(wdm.encode())
+		if action in ('create_file', 'modify_file', 'delete_file'):
+			self.invalidate(item['path'])
+		elif action == 'move_file':
+			if source_item and source_item.get('root') == 'gcodes':
+				self.invalidate(source_item['path'])
+			self.invalidate(item['path'])
+		elif action == 'delete_dir':
+			self.invalidate(item['path'], prefix=True)
+		elif action == 'move_dir':
+			if source_item and source_item.get('root') == 'gcodes':
+				self.invalidate(source_item['path'], prefix=True)
+
+	def append(self, record):
+		# Called with the lock held
+		try:
+			if self.lines > 2 * len(self.entries) + 64:
+				self.compact()
+			with open(self.filename, 'ab') as f:
+				f.write(json_dumps(record) + b'\n')
+			self.lines += 1
+		except OSError as e:
+			logger.error("metadata cache write failed: %s", e)
+
+	def compact(self):
+		tmp = self.filename + '.tmp'
+		try:
+			with open(tmp, 'wb') as f:
+				for path, (modified, meta) in self.entries.items():
+					f.write(json_dumps({'path': path, 'modified': modified, 'meta': meta}) + b'\n')
+			os.replace(tmp, self.filename)
+			self.lines = len(self.entries)
+		except OSError as e:
+			logger.error("metadata cache write failed: %s", e)
+
+
+ESTIMATE_SMOOTHING = 0.1
+RATE_SMOOTHING = 0.05
+
+class PrintTimeEstimator:
+	# Remaining time of the running job, O(1) per sample. Two predictions of
+	# the total print time are blended by file progress: the slicer estimate
+	# for the part still to print, trusted early on, and the remaining file
+	# fraction over the smoothed print rate (progress per second of
+	# print_duration), trusted later. The blend is smoothed exponentially and
+	# the remaining time is counted down from it, so it does not jump.
+	def __init__(self, smoothing=ESTIMATE_SMOOTHING, rate_smoothing=RATE_SMOOTHING):
+		self.smoothing = smoothing
+		self.rate_smoothing = rate_smoothing
+		self.reset()
+
+	def reset(self, filename=None, estimated_time=None):
+		self.filename = filename
+		self.estimated_time = estimated_time
+		self.rate = None
+		self.last_progress = None
+		self.last_duration = None
+		self.total = None
+		self.remaining = None
+
+	def update(self, progress, duration):
+		if progress >= 1.0:
+			self.remaining = 0.0
+			return self.remaining
+		if self.last_progress is None or progress < self.last_progress:
+			self.last_progress, self.last_duration = progress, duration
+		elif progress > self.last_progress and duration > self.last_duration:
+			# Only sample while the file advances, heating does not count
+			rate = (progress - self.last_progress) / (duration - self.last_duration)
+			if self.rate is None:
+				self.rate = rate
+			else:
+				self.rate += self.rate_smoothing * (rate - self.rate)
+			self.last_progress, self.last_duration = progress, duration
+
+		slicer = duration + self.estimated_time * (1.0 - progress) if self.estimated_time else None
+		observed = duration + (1.0 - progress) / self.rate if self.rate else None
+		if slicer is not None and observed is not None:
+			total = (1.0 - progress) * slicer + progress * observed
+		elif slicer is not None or observed is not None:
+			total = slicer if slicer is not None else observed
+		else:
+			return self.remaining
 
-	def polling(self):
+		if self.total is None:
+			self.total = total
+		else:
+			self.total += self.smoothing * (total - self.total)
+		self.remaining = max(0.0, self.total - duration)
+		return self.remaining
+
+
+class StatusQueryPlanner:
+	# Builds a single attribute-level objects/query request for the fields
+	# the display consumes. The compiled URL is cached and only rebuilt when
+	# the requested objects or fields change (e.g. a new LED shows up).
+	def __init__(self, path='/printer/objects/query'):
+		self.path = path
+		self.key = None
+		self.url = None
+
+	def compile(self, objects):
+		key = tuple((obj, tuple(fields)) for obj, fields in objects.items())
+		if key != self.key:
+			args = []
+			for obj, fields in key:
+				args.append('%s=%s' % (quote(obj), ','.join(fields)))
+			self.url = self.path + '?' + '&'.join(args)
+			self.key = key
+		return self.url
+
+
+# HTTP timeouts (connect, read) per command lane. A gcode script only returns
+# once Klipper has executed it, M109/M190 may take minutes.
+COMMAND_TIMEOUTS = {
+	'gcode': (3.0, None),
+	'control': (3.0, 30.0),
+}
+COMMAND_QUEUE_SIZE = 64
+# Seconds a jog or setpoint may wait on the gcode lane, e.g. behind an M109.
+# Running it minutes later would be worse than dropping it.
+INTERACTIVE_DEADLINE = 2.0
+GET_SECONDS = metrics.histogram('klippertft_moonraker_request_seconds', 'HTTP round trip to Moonraker',
+	method='GET', lane='query')
+
+class CommandLane:
+	# Runs submitted commands one after another on its own worker thread, in
+	# submission order. A command still queued after its deadline is dropped.
+	def __init__(self, name, size=COMMAND_QUEUE_SIZE):
+		self.name = name
+		self.queue = queue.Queue(size)
+		self.completed = 0
+		self.failed = 0
+		self.expired = 0
+		self.rejected = 0
+		self.latency_total = 0.0
+		self.latency_max = 0.0
+		self.thread = threading.Thread(target=self.worker, name="lane-%s" % name, daemon=True)
+		self.thread.start()
+
+	def submit(self, fn, deadline=None):
+		future = Future()
+		try:
+			self.queue.put_nowait((future, fn, time.monotonic(), deadline))
+		except queue.Full:
+			self.rejected += 1
+			future.set_exception(RuntimeError("%s lane full" % self.name))
+		return future
+
+	def worker(self):
 		while True:
-			if self.stop_threads:
+			item = self.queue.get()
+			if item is None:
 				break
-			res = self.poll.poll(1000.)
-			for fd, event in res:
-				self.process_socket()
-			with self.lock:
-				self.send_line()
+			future, fn, queued, deadline = item
+			if not future.set_running_or_notify_cancel():
+				continue
+			start = time.monotonic()
+			if deadline is not None and start - queued > deadline:
+				self.expired += 1
+				future.set_exception(TimeoutError("%s command expired in queue" % self.name))
+				continue
+			try:
+				result = fn()
+			except Exception as e:
+				self.failed += 1
+				future.set_exception(e)
+			else:
+				self.completed += 1
+				future.set_result(result)
+			elapsed = time.monotonic() - queued
+			self.latency_total += elapsed
+			self.latency_max = max(self.latency_max, elapsed)
+
+	def stats(self):
+		done = self.completed + self.failed
+		return {
+			'queue_depth': self.queue.qsize(),
+			'completed': self.completed,
+			'failed': self.failed,
+			'expired': self.expired,
+			'rejected': self.rejected,
+			'latency_avg': self.latency_total / done if done else 0.0,
+			'latency_max': self.latency_max,
+		}
 
+	def stop(self):
+		try:
+			self.queue.put_nowait(None)
+		except queue.Full:
+			pass
+
+
+class CommandPipeline:
+	# Ordered, non-blocking execution of Moonraker POST requests. Gcode
+	# scripts share one lane so they reach Klipper in order, print control
+	# (start/pause/resume/cancel) has its own lane and is never stuck behind
+	# a long running script.
+	def __init__(self, session, base_address):
+		self.session = session
+		self.base_address = base_address
+		self.lanes = {name: CommandLane(name) for name in COMMAND_TIMEOUTS}
+		self.post_seconds = {name: metrics.histogram('klippertft_moonraker_request_seconds',
+			'HTTP round trip to Moonraker', method='POST', lane=name) for name in COMMAND_TIMEOUTS}
+
+	def send(self, path, json, lane='gcode'):
+		# Blocking POST, for code already running on a lane
+		start = time.monotonic()
+		r = self.session.post(self.base_address + path, json=json, timeout=COMMAND_TIMEOUTS[lane])
+		self.post_seconds[lane].observe(time.monotonic() - start)
+		r.raise_for_status()
+		return r.json()
+
+	def post(self, path, json, lane='gcode', deadline=None):
+		return self.lanes[lane].submit(lambda: self.send(path, json, lane), deadline)
+
+	def stats(self):
+		return {name: lane.stats() for name, lane in self.lanes.items()}
+
+	def stop(self):
+		for lane in self.lanes.values():
+			lane.stop()
+
+
+# Window in which rapid jog and setpoint input from the TFT is merged
+INPUT_COALESCE_WINDOW = 0.15
+
+class InputCoalescer:
+	# Merges rapid input before it turns into commands: relative moves are
+	# summed per axis, setpoints only keep their last value. Everything
+	# pending is sent as one gcode script once the window opened by the
+	# first input has passed, or earlier through flush().
+	def __init__(self, printer, window=INPUT_COALESCE_WINDOW, call_later=None):
+		self.printer = printer
+		self.window = window
+		self.call_later = call_later or start_timer
+		self.lock = threading.Lock()
+		# Held from take() until the script is submitted, so a timer flush
+		# and an event flush followed by its own command keep their order
+		self.send_lock = threading.Lock()
+		self.moves = {}
+		self.setpoints = {}
+		self.timer = None
+		# While held setpoints are only collected, release() sends them
+		self.held = False
+
+	def move(self, axis, distance, speed):
+		with self.lock:
+			pending = self.moves.get(axis)
+			if pending:
+				pending[0] += float(distance)
+				pending[1] = speed
+			else:
+				self.moves[axis] = [float(distance), speed]
+			self.schedule()
+
+	def setpoint(self, key, func, value):
+		with self.lock:
+			self.setpoints[key] = (func, value)
+			self.schedule()
+
+	def schedule(self):
+		if self.timer is None and not self.held:
+			self.timer = self.call_later(self.window, self.flush)
+
+	def hold(self):
+		with self.lock:
+			self.held = True
+
+	def release(self):
+		with self.lock:
+			self.held = False
+		self.flush()
+
+	def take(self):
+		with self.lock:
+			if self.timer:
+				self.timer.cancel()
+				self.timer = None
+			moves, self.moves = self.moves, {}
+			setpoints, self.setpoints = self.setpoints, {}
+		return moves, setpoints
+
+	def flush(self, moves=True):
+		# With moves=False pending moves are dropped (stop, motor off), the
+		# setpoints still go out, a heater off must never be lost
+		if self.held:
+			return
+		with self.send_lock:
+			pending, setpoints = self.take()
+			if pending and not moves:
+				logger.info("discarded pending moves")
+				pending = {}
+			if not pending and not setpoints:
+				return
+			with self.printer.gcode_batch(INTERACTIVE_DEADLINE):
+				for func, value in setpoints.values():
+					func(value)
+				for axis, (distance, speed) in pending.items():
+					if distance:
+						self.printer.moveRelative(axis, round(distance, 3), speed)
+
+
+# Startup waits for Moonraker's /server/config, the discovery requests
+# after it run concurrently
+STARTUP_RETRY_INTERVAL = 0.5
+STARTUP_WORKERS = 4
 
 class MoonrakerSocket:
 	def __init__(self, address, port, api_key):
@@ -186,7 +1076,6 @@ class MoonrakerSocket:
 
 
 class PrinterData:
-	event_loop = None
 	HAS_HOTEND = True
 	HOTENDS = 1
 	HAS_HEATED_BED = True
@@ -234,8 +1123,33 @@ class PrinterData:
 
 	LED = []
 
-	def __init__(self, API_Key, URL='127.0.0.1', callback=None):
+	# Klipper objects and the fields of them consumed by update_variable.
+	# They are subscribed to on the Klippy socket and the resulting deltas
+	# are merged into the status store as they arrive.
+	STATUS_FIELDS = {
+		'extruder': ['temperature', 'target'],
+		'heater_bed': ['temperature', 'target'],
+		'gcode_move': ['homing_origin', 'gcode_position', 'extrude_factor', 'absolute_coordinates', 'absolute_extrude', 'speed', 'speed_factor'],
+		'fan': ['speed'],
+		'print_stats': ['filename', 'state', 'total_duration', 'print_duration'],
+		'display_status': ['progress'],
+		'virtual_sdcard': ['is_active', 'progress'],
+		'toolhead': ['position', 'homed_axes', 'max_velocity', 'max_accel', 'minimum_cruise_ratio', 'square_corner_velocity'],
+	}
+	LED_FIELDS = ['color_data']
+	# Discovered once per start, kept in the warm start snapshot
+	SNAPSHOT_FIELDS = ('file_path', 'LED', 'MACHINE_SIZE', 'SHORT_BUILD_VERSION', 'X_MAX_POS', 'Y_MAX_POS')
+
+	def __init__(self, API_Key, URL='127.0.0.1', callback=None, port=80, gcode_transport='http',
+				 loop=None, dispatch=None):
 		self.response_callback = callback
+		# 'klippy' sends gcode/script on the Klippy socket, HTTP is the fallback
+		self.gcode_transport  = gcode_transport
+		# Event loop serving the sockets and how socket callbacks get to the
+		# thread owning this object, see runtime.py. Without them each socket
+		# has a polling thread which runs the callbacks itself.
+		self.loop             = loop
+		self.dispatch         = dispatch
 		self.BABY_Z_VAR       = 0
 		self.print_speed      = 100
 		self.flow_percentage  = 100
@@ -259,20 +1173,101 @@ class PrinterData:
 		self.status                 = None
 		self.print_time             = None
 		self.print_percent			= None
-		self.last_percent_update	= None
+		self.estimator              = PrintTimeEstimator()
 		self.max_velocity           = None
 		self.max_accel              = None
 		self.minimum_cruise_ratio   = None
 		self.square_corner_velocity = None
 
-		self.op = MoonrakerSocket(URL, 80, API_Key)
-		print(self.op.base_address)
+		# Klippy subscription state store
+		self.status_store           = {}
+		self.status_lock            = threading.Lock()
+		self.status_event           = threading.Event()
+		self.subscribed             = False
+		self.status_query           = StatusQueryPlanner()
+		self.file_index             = FileIndex()
+		self.ms                     = None
+
+		# Slicer metadata, fetched in the background for the files on screen
+		self.metadata               = MetadataCache(cache_path('metadata.jsonl'))
+		self.metadata_lane          = CommandLane('metadata')
+		self.metadata_pending       = set()
+		self.metadata_failed        = {}
+		atexit.register(self.metadata_lane.stop)
+
+		self.op = MoonrakerSocket(URL, port, API_Key)
+		moonraker_log.info("Moonraker at %s", self.op.base_address)
+		self.commands = CommandPipeline(self.op.s, self.op.base_address)
+		self.gcode_batch_state = threading.local()
+		atexit.register(self.commands.stop)
+		self.ks                     = None
+		self.klippy_sock            = None
+
+	def start(self):
+		# Discovery, blocks until Moonraker answers. Independent requests
+		# run concurrently. Returns (step, seconds) for each step.
+		timings = []
+
+		def timed(name, fn):
+			start = time.monotonic()
+			try:
+				fn()
+			except Exception as e:
+				moonraker_log.error("startup step %s failed: %s", name, e)
+			finally:
+				timings.append((name, time.monotonic() - start))
+
+		timed('server/config', self.find_klippy_sock)
+		with ThreadPoolExecutor(STARTUP_WORKERS, thread_name_prefix='startup') as pool:
+			pool.submit(timed, 'update/status', self.read_version)
+			pool.submit(timed, 'objects/query', self.read_toolhead)
+			# The LED objects are part of the subscription and status query
+			timed('objects/list', self.init_features)
+			pool.submit(timed, 'klippy', self.klippy_start)
+			pool.submit(timed, 'moonraker.sock', self.moonraker_start)
+			pool.submit(timed, 'status', self.read_status)
+			if self.file_index.loaded:
+				# Restored from the snapshot, files may have changed meanwhile
+				pool.submit(timed, 'files/list', self.read_files)
+		return timings
+
+	def snapshot_state(self):
+		return {name: getattr(self, name, None) for name in self.SNAPSHOT_FIELDS}
+
+	def restore_state(self, state, files=None):
+		for name in self.SNAPSHOT_FIELDS:
+			if state.get(name) is not None:
+				setattr(self, name, state[name])
+		self.set_file_path(self.file_path)
+		if files is not None:
+			current = [fl for fl in files if self.file_current(fl)]
+			if len(current) < len(files):
+				logger.info("dropped %d changed files from the snapshot", len(files) - len(current))
+			self.file_index.load(current)
+
+	def file_current(self, fl):
+		# Checked against the gcode directory when it is local
+		if not self.file_path or not os.path.isdir(self.file_path):
+			return True
+		try:
+			return os.stat(os.path.join(self.file_path, fl['path'])).st_mtime == fl.get('modified')
+		except OSError:
+			return False
 
+	def find_klippy_sock(self):
 		# try to find klippy sock in Moonraker config or use generic value
 		info = None
+		waited = False
 		while info is None:
-			info = self.getREST("/server/config")
-			time.sleep(1)
+			try:
+				info = self.getREST("/server/config")
+			except ConnectionError:
+				info = None
+			if info is None:
+				if not waited:
+					moonraker_log.info("waiting for Moonraker at %s", self.op.base_address)
+					waited = True
+				time.sleep(STARTUP_RETRY_INTERVAL)
 
 		klippy_sock_found = False
 		if 'result' in info:
@@ -285,40 +1280,107 @@ class PrinterData:
 		if not klippy_sock_found:
 			self.klippy_sock = os.path.expanduser("~/printer_data/comms/klippy.sock")
 
+	# ------------- Klipper Function ----------
+	def deliver(self, fn):
+		if self.dispatch is None:
+			return fn
+		return lambda *args: self.dispatch(fn, *args)
+
+	def klippy_start(self):
+		# Connects in the background and keeps reconnecting
+		self.subscribed = False
+		self.ks = KlippySupervisor(self.klippy_sock, callback=self.deliver(self.klippy_callback), loop=self.loop,
+			on_connect=self.klippy_connected, on_disconnect=self.deliver(self.klippy_lost))
+
+	def klippy_connected(self, ks):
+		# Every (re)connect: subscribe again, its response carries the full
+		# status of the subscribed objects, and query the config once
+		ks.request("objects/subscribe", {
+			"objects": self.subscription_objects(),
+			"response_template": {}
+		}).add_done_callback(self.deliver(self.subscribe_done))
+		ks.request("objects/query", {"objects": {"configfile": ["config"]}}).add_done_callback(self.deliver(self.query_done))
+		ks.request("gcode/subscribe_output", {"response_template": {}})
+
+	def klippy_lost(self):
+		# The store is stale until the resync, status falls back to Moonraker
+		self.subscribed = False
+		with self.status_lock:
+			self.status_store.clear()
+
+	def subscribe_done(self, future):
+		if future.cancelled() or future.exception():
+			klippy_log.error("subscription failed: %s", None if future.cancelled() else future.exception())
+			return
+		self.handle_status(future.result()['status'])
+		self.subscribed = True
+		self.status_event.set()
 
-		self.klippy_start()
+	def query_done(self, future):
+		if future.cancelled() or future.exception():
+			klippy_log.error("query failed: %s", None if future.cancelled() else future.exception())
+			return
+		self.handle_status(future.result()['status'])
+
+	# ------------- Moonraker Notifications ----------
+	def moonraker_start(self):
+		# Moonraker's unix socket uses the same framing as Klippy's. It is
+		# only used to get notified about changes to the gcode files.
+		moonraker_sock = os.path.join(os.path.dirname(self.klippy_sock), 'moonraker.sock')
+		if not os.path.exists(moonraker_sock):
+			moonraker_log.info("no Moonraker socket at %s, file list will be polled", moonraker_sock)
+			return
+		self.ms = KlippySupervisor(moonraker_sock, callback=self.deliver(self.moonraker_callback), jsonrpc=True,
+			loop=self.loop, on_connect=self.moonraker_connected, on_disconnect=self.deliver(self.moonraker_lost))
+
+	def moonraker_connected(self, ms):
+		ms.request("server.connection.identify", {
+			"client_name": "KlipperTFT",
+			"version": "0.0.1",
+			"type": "other",
+			"url": "https://github.com/judokan9/KlipperTFT_UART"
+		})
 
-		self.init_features()
+	def moonraker_lost(self):
+		# Changes while disconnected were missed, the listing is read again
+		self.file_index.invalidate()
 
-		self.event_loop = asyncio.new_event_loop()
-		threading.Thread(target=self.event_loop.run_forever, daemon=True).start()
+	def connection_stats(self):
+		stats = {'klippy': self.ks.stats() if self.ks is not None else None}
+		if self.ms is not None:
+			stats['moonraker'] = self.ms.stats()
+		return stats
 
-	# ------------- Klipper Function ----------
-	def klippy_start(self):
-		self.ks = KlippySocket(self.klippy_sock, callback=self.klippy_callback)
-		subscribe = {
-			"id": 4001,
-			"method": "objects/subscribe",
-			"params": {
-				"objects": {
-					"toolhead": [
-						"position"
-					]
-				},
-				"response_template": {}
-			}
-		}
-		self.klippy_z_offset = '{"id": 4002, "method": "objects/query", "params": {"objects": {"configfile": ["config"]}}}'
-		self.klippy_home = '{"id": 4003, "method": "objects/query", "params": {"objects": {"toolhead": ["homed_axes"]}}}'
-		self.gcode = '{"id": 4004, "method": "gcode/subscribe_output", "params": {"response_template":{}}}'
+	def moonraker_callback(self, moonrakerData):
+		if moonrakerData.get('method') == 'notify_filelist_changed':
+			for change in moonrakerData['params']:
+				self.file_index.apply(change['action'], change['item'], change.get('source_item'))
+				self.metadata.apply(change['action'], change['item'], change.get('source_item'))
 
-		self.ks.queue_line(json.dumps(subscribe))
-		self.ks.queue_line(self.klippy_z_offset)
-		self.ks.queue_line(self.klippy_home)
-		self.ks.queue_line(self.gcode)
+	def file_notifications(self):
+		return self.ms is not None and self.ms.connected
 
-	def klippy_callback(self, line):
-		klippyData = json.loads(line)
+	def subscription_objects(self):
+		objects = dict(self.STATUS_FIELDS)
+		if len(self.LED) > 0:
+			objects['led %s' % self.LED[0]] = self.LED_FIELDS
+		return objects
+
+	def merge_status(self, status):
+		changed = False
+		with self.status_lock:
+			for obj, fields in status.items():
+				if obj in self.STATUS_FIELDS or obj.startswith('led '):
+					self.status_store.setdefault(obj, {}).update(fields)
+					changed = True
+		if changed:
+			self.status_event.set()
+
+	def status_snapshot(self):
+		with self.status_lock:
+			return {obj: dict(fields) for obj, fields in self.status_store.items()}
+
+	def klippy_callback(self, klippyData):
 		#print("klippy_callback:")
 		#print(json.dumps(klippyData, indent=2))
 		status = None
@@ -337,75 +1399,98 @@ class PrinterData:
 						self.response_callback(resp, 'response')
 
 		if status:
-			if 'toolhead' in status:
-				if 'position' in status['toolhead']:
-					if self.current_position.x != status['toolhead']['position'][0]:
-						self.current_position.x = status['toolhead']['position'][0]
-						self.current_position.updated = True
-					if self.current_position.y != status['toolhead']['position'][1]:
-						self.current_position.y = status['toolhead']['position'][1]
-						self.current_position.updated = True
-					if self.current_position.z != status['toolhead']['position'][2]:
-						self.current_position.z = status['toolhead']['position'][2]
-						self.current_position.updated = True
-					if self.current_position.e != status['toolhead']['position'][3]:
-						self.current_position.e = status['toolhead']['position'][3]
-						self.current_position.updated = True
-
-				if 'homed_axes' in status['toolhead']:
-					if 'x' in status['toolhead']['homed_axes']:
-						self.current_position.home_x = True
-					else:
-						self.current_position.home_x = False
-					if 'y' in status['toolhead']['homed_axes']:
-						self.current_position.home_y = True
-					else:
-						self.current_position.home_y = False
-					if 'z' in status['toolhead']['homed_axes']:
-						self.current_position.home_z = True
-					else:
-						self.current_position.home_z = False
-
-				if 'max_velocity' in status['toolhead']:
-					if self.max_velocity != status['toolhead']['max_velocity']:
-						self.max_velocity = status['toolhead']['max_velocity']
-				if 'max_accel' in status['toolhead']:
-					if self.max_accel != status['toolhead']['max_accel']:
-						self.max_accel = status['toolhead']['max_accel']
-				if 'minimum_cruise_ratio' in status['toolhead']:
-					if self.minimum_cruise_ratio != status['toolhead']['minimum_cruise_ratio']:
-						self.minimum_cruise_ratio = status['toolhead']['minimum_cruise_ratio']
-				if 'square_corner_velocity' in status['toolhead']:
-					if self.square_corner_velocity != status['toolhead']['square_corner_velocity']:
-						self.square_corner_velocity = status['toolhead']['square_corner_velocity']
-
-			if 'configfile' in status:
-				if 'config' in status['configfile']:
-					if 'bltouch' in status['configfile']['config']:
-						if 'z_offset' in status['configfile']['config']['bltouch']:
-							if status['configfile']['config']['bltouch']['z_offset']:
-								self.BABY_Z_VAR = float(status['configfile']['config']['bltouch']['z_offset'])
-					if 'virtual_sdcard' in status['configfile']['config']:
-						if 'path' in status['configfile']['config']['virtual_sdcard']:
-							self.file_path = status['configfile']['config']['virtual_sdcard']['path']
+			self.handle_status(status)
+
+	def handle_status(self, status):
+		self.merge_status(status)
+		if 'toolhead' in status:
+			if 'position' in status['toolhead']:
+				if self.current_position.x != status['toolhead']['position'][0]:
+					self.current_position.x = status['toolhead']['position'][0]
+					self.current_position.updated = True
+				if self.current_position.y != status['toolhead']['position'][1]:
+					self.current_position.y = status['toolhead']['position'][1]
+					self.current_position.updated = True
+				if self.current_position.z != status['toolhead']['position'][2]:
+					self.current_position.z = status['toolhead']['position'][2]
+					self.current_position.updated = True
+				if self.current_position.e != status['toolhead']['position'][3]:
+					self.current_position.e = status['toolhead']['position'][3]
+					self.current_position.updated = True
+
+			if 'homed_axes' in status['toolhead']:
+				if 'x' in status['toolhead']['homed_axes']:
+					self.current_position.home_x = True
+				else:
+					self.current_position.home_x = False
+				if 'y' in status['toolhead']['homed_axes']:
+					self.current_position.home_y = True
+				else:
+					self.current_position.home_y = False
+				if 'z' in status['toolhead']['homed_axes']:
+					self.current_position.home_z = True
+				else:
+					self.current_position.home_z = False
+
+			if 'max_velocity' in status['toolhead']:
+				if self.max_velocity != status['toolhead']['max_velocity']:
+					self.max_velocity = status['toolhead']['max_velocity']
+			if 'max_accel' in status['toolhead']:
+				if self.max_accel != status['toolhead']['max_accel']:
+					self.max_accel = status['toolhead']['max_accel']
+			if 'minimum_cruise_ratio' in status['toolhead']:
+				if self.minimum_cruise_ratio != status['toolhead']['minimum_cruise_ratio']:
+					self.minimum_cruise_ratio = status['toolhead']['minimum_cruise_ratio']
+			if 'square_corner_velocity' in status['toolhead']:
+				if self.square_corner_velocity != status['toolhead']['square_corner_velocity']:
+					self.square_corner_velocity = status['toolhead']['square_corner_velocity']
+
+		if 'configfile' in status:
+			if 'config' in status['configfile']:
+				if 'bltouch' in status['configfile']['config']:
+					if 'z_offset' in status['configfile']['config']['bltouch']:
+						if status['configfile']['config']['bltouch']['z_offset']:
+							self.BABY_Z_VAR = float(status['configfile']['config']['bltouch']['z_offset'])
+				if 'virtual_sdcard' in status['configfile']['config']:
+					if 'path' in status['configfile']['config']['virtual_sdcard']:
+						self.set_file_path(status['configfile']['config']['virtual_sdcard']['path'])
+
+	def set_file_path(self, path):
+		# As Klipper resolves it, the configured value is usually ~/printer_data/gcodes
+		self.file_path = os.path.normpath(os.path.expanduser(path)) if path else path
 
 	def init_features(self):
 		try:
 			objects = self.getREST('/printer/objects/list')['result']['objects']
 		except:
-			print("Could not read printer features objects!")
+			moonraker_log.error("could not read printer features objects")
+			return
 
+		leds = []
 		for obj in objects:
 			if 'led' in obj:
 				led = obj.split(' ')[1]
-				self.LED.append(led)
+				leds.append(led)
+		self.LED = leds
+
+	def homed(self):
+		return self.current_position.home_x and self.current_position.home_y and self.current_position.home_z
+
+	def query_homed(self):
+		# Blocks up to a second, the toolhead status or {} if it failed
+		try:
+			return self.ks.request("objects/query", {
+				"objects": {"toolhead": ["homed_axes"]}
+			}, timeout=1.0).result()['status']
+		except Exception as e:
+			klippy_log.warning("homing state query failed: %s", e)
+			return {}
 
 	def ishomed(self):
-		if self.current_position.home_x and self.current_position.home_y and self.current_position.home_z:
+		if self.homed():
 			return True
-		else:
-			self.ks.queue_line(self.klippy_home)
-			return False
+		self.handle_status(self.query_homed())
+		return self.homed()
 
 	def offset_z(self, new_offset):
 		self.BABY_Z_VAR = new_offset
@@ -413,7 +1498,7 @@ class PrinterData:
 
 	def add_mm(self, axs, new_offset):
 		gc = 'TESTZ Z={}'.format(new_offset)
-		print(axs, gc)
+		logger.debug("%s %s", axs, gc)
 		self.sendGCode(gc)
 
 	def probe_adjust(self, change):
@@ -423,11 +1508,14 @@ class PrinterData:
 			strchange = str(change)
 
 		gc = 'SET_GCODE_OFFSET Z_ADJUST={} MOVE=1'.format(strchange)
-		print(gc)
+		logger.debug("%s", gc)
 		self.sendGCode(gc)
 
-	def probe_calibrate(self):
-		if self.ishomed() == False:
+	def probe_calibrate(self, status=None):
+		# status: from query_homed() run beforehand, off the calling thread
+		if status is not None:
+			self.handle_status(status)
+		if not (self.homed() if status is not None else self.ishomed()):
 			self.sendGCode('G28')
 		self.sendGCode('PROBE_CALIBRATE')
 		self.sendGCode('G1 Z0.0')
@@ -435,37 +1523,66 @@ class PrinterData:
 	# ------------- OctoPrint Function ----------
 
 	def getREST(self, path):
+		start = time.monotonic()
 		r = self.op.s.get(self.op.base_address + path)
+		GET_SECONDS.observe(time.monotonic() - start)
 		d = r.content.decode('utf-8')
 		try:
 			return json.loads(d)
 		except JSONDecodeError:
-			print('Decoding JSON has failed')
+			moonraker_log.error("decoding JSON of %s failed", path)
 		return None
 
-	async def _postREST(self, path, json):
-		self.op.s.post(self.op.base_address + path, json=json)
-
-	def postREST(self, path, json):
-		self.event_loop.call_soon_threadsafe(asyncio.create_task,self._postREST(path,json))
-
-	def init_Webservices(self):
-		try:
-			requests.get(self.op.base_address)
-		except ConnectionError:
-			print('Web site does not exist')
-			return
-		else:
-			print('Web site exists')
-		if self.getREST('/api/printer') is None:
-			return
-		self.update_variable()
-
+	def postREST(self, path, json, lane=None, deadline=None, on_done=None):
+		# Queues the request and returns a future for its response. Failures
+		# are reported through on_done and the response callback.
+		if lane is None:
+			lane = 'control' if path.startswith('/printer/print/') else 'gcode'
+		future = self.commands.post(path, json, lane, deadline)
+		self.watch_command(future, path, on_done)
+		return future
+
+	def watch_command(self, future, what, on_done=None):
+		def done(future):
+			if not future.cancelled() and future.exception() is not None:
+				moonraker_log.error("%s failed: %s", what, future.exception())
+				if self.response_callback:
+					self.response_callback("%s: %s" % (what, future.exception()), 'error')
+			if on_done:
+				on_done(future)
+
+		future.add_done_callback(done)
+
+	def send_script(self, script, deadline=None):
+		if self.gcode_transport != 'klippy':
+			return self.postREST('/printer/gcode/script', json={'script': script}, deadline=deadline)
+
+		def run():
+			# Runs on the gcode lane, so scripts stay in order whichever
+			# path they take
+			if self.ks.connected:
+				try:
+					return self.ks.request('gcode/script', {'script': script}).result()
+				except KlippyConnectionError:
+					pass
+			return self.commands.send('/printer/gcode/script', {'script': script})
+
+		future = self.commands.lanes['gcode'].submit(run, deadline)
+		self.watch_command(future, 'gcode/script')
+		return future
+
+	def read_version(self):
 		#alternative approach
 		#full_version = self.getREST('/printer/info')['result']['software_version']
 		#self.SHORT_BUILD_VERSION = '-'.join(full_version.split('-',2)[:2])
 		self.SHORT_BUILD_VERSION = self.getREST('/machine/update/status?refresh=false')['result']['version_info']['klipper']['version']
 
+	def read_status(self):
+		data = self.query_status()
+		if data is not None:
+			self.apply_status(data)
+
+	def read_toolhead(self):
 		data = self.getREST('/printer/objects/query?toolhead')['result']['status']
 		#print(json.dumps(data, indent=2))
 		toolhead = data['toolhead']
@@ -487,7 +1604,7 @@ class PrinterData:
 		try:
 			gcode_store = self.getREST('/server/gcode_store?count=%d' % count)['result']['gcode_store']
 		except:
-			print("GCode store read failed!")
+			moonraker_log.error("gcode store read failed")
 
 		return gcode_store
 
@@ -496,7 +1613,7 @@ class PrinterData:
 		try:
 			objects = self.getREST('/printer/objects/list')['result']['objects']
 		except:
-			print("Could not read macro objects!")
+			moonraker_log.error("could not read macro objects")
 
 		for obj in objects:
 			if 'gcode_macro' in obj:
@@ -508,33 +1625,103 @@ class PrinterData:
 					macros.append(macro)
 		return macros
 
+	def list_files(self):
+		# Blocking GET of the full listing
+		return self.getREST('/server/files/list')["result"]
+
+	def load_files(self, files):
+		# A full listing, metadata of files no longer in it is dropped here
+		# rather than on every page request
+		self.file_index.load(files)
+		self.metadata.retain(set(self.file_index.snapshot()[1]))
+
+	def read_files(self):
+		self.load_files(self.list_files())
+
+	def files_stale(self, refresh=False):
+		# Without change notifications a refresh has to re-read the listing
+		return not self.file_index.loaded or (refresh and not self.file_notifications())
+
 	def GetFiles(self, refresh=False):
-		if not self.files or refresh:
+		if self.files_stale(refresh):
 			try:
-				self.files = self.getREST('/server/files/list')["result"]
+				self.read_files()
 			except:
-				print("Exception 418")
-		names = []
-		for fl in self.files:
-			names.append(fl["path"])
+				moonraker_log.error("file list read failed")
+		return self.listed_files()
+
+	def listed_files(self):
+		# The names as they are indexed now, never reads
+		self.files, names = self.file_index.snapshot()
 		return names
 
-	def update_variable(self):
+	def file_metadata(self, path):
+		# Cached slicer metadata or None, checked against the listing if the
+		# file is in it
+		return self.metadata.get(path, self.file_index.modified(path))
+
+	def prefetch_metadata(self, paths):
+		# Queue lookups for files without current metadata, never waits.
+		# Files need not be listed, a print started elsewhere is looked up
+		# before the TFT ever asked for the file list.
+		for path in paths:
+			modified = self.file_index.modified(path)
+			if path in self.metadata_pending:
+				continue
+			if path in self.metadata_failed and self.metadata_failed[path] == modified:
+				continue
+			if self.metadata.get(path, modified) is not None:
+				continue
+			self.metadata_pending.add(path)
+			future = self.metadata_lane.submit(lambda path=path, modified=modified: self.fetch_metadata(path, modified))
+			if future.done():
+				self.metadata_pending.discard(path)
+
+	def fetch_metadata(self, path, modified):
+		try:
+			r = self.op.s.get(self.op.base_address + '/server/files/metadata',
+				params={'filename': path}, timeout=METADATA_TIMEOUT)
+			r.raise_for_status()
+			result = r.json()['result']
+			meta = {k: result[k] for k in METADATA_FIELDS if k in result}
+			self.metadata.put(path, result.get('modified', modified), meta)
+			return meta
+		except Exception as e:
+			moonraker_log.warning("metadata for %s failed: %s", path, e)
+			self.metadata_failed[path] = modified
+			raise
+		finally:
+			self.metadata_pending.discard(path)
+
+	def update_variable(self, data=None):
+		# data is a status fetched beforehand, see fetch_status(). While
+		# Klippy is away its supervisor reconnects, the last state stays.
 		if self.ks.connected == False:
-			self.ks.klippyExit()
-			self.klippy_start()
 			return False
-		query = '/printer/objects/query?extruder&heater_bed&gcode_move&fan&print_stats&motion_report&toolhead&display_status'
 
-		if len(self.LED) > 0:
-			query = query + '&led %s' % self.LED[0]
+		if data is None:
+			data = self.fetch_status()
+			if data is None:
+				return False
+		return self.apply_status(data)
 
-		try:
-			data = self.getREST(query)['result']['status']
-		except:
-			print("Exception 431")
-			return False
+	def live_status(self):
+		# Status from the Klippy subscription, None until it covers everything
+		if not self.subscribed:
+			return None
+		data = self.status_snapshot()
+		if not all(obj in data for obj in self.STATUS_FIELDS):
+			return None
+		return data
 
+	def fetch_status(self):
+		data = self.live_status()
+		if data is None:
+			# Subscription not (yet) live, fall back to polling Moonraker
+			data = self.query_status()
+		return data
+
+	def apply_status(self, data):
 		#print("update_variable:")
 		#print(json.dumps(data, indent=2))
 
@@ -588,30 +1775,34 @@ class PrinterData:
 				Update = True
 		except:
 			pass #missing key, shouldn't happen, fixes misses on conditionals ¯\_(ツ)_/¯
-		try:
-			self.job_Info = self.getREST('/printer/objects/query?virtual_sdcard&print_stats')['result']['status']
-		except:
-			print("Exception 470")
-			return False
+
+		self.job_Info = {
+			'virtual_sdcard': data['virtual_sdcard'],
+			'print_stats': data['print_stats']
+		}
 
 		if data['display_status']:
-			if self.print_percent is not None:
-				if int(self.print_percent*100) is not int(data['display_status']['progress']*100):
-					self.last_percent_update = time.time()
-			else:
-				self.last_percent_update = time.time()
 			self.print_percent = data['display_status']['progress']
 
 		if self.job_Info:
 			self.file_name = self.job_Info['print_stats']['filename']
 			self.status = self.job_Info['print_stats']['state']
 			self.print_time = self.job_Info['print_stats']['total_duration']
+			self.update_estimate()
 
 		if self.job_Info:
 			self.HMI_flag.print_finish = self.getPercent() == 100.0
 
 		return Update
 
+	def query_status(self):
+		query = self.status_query.compile(self.subscription_objects())
+		try:
+			return self.getREST(query)['result']['status']
+		except:
+			moonraker_log.error("status query failed")
+			return None
+
 	def getState(self):
 		if self.job_Info:
 			return self.job_Info['print_stats']['state']
@@ -635,34 +1826,41 @@ class PrinterData:
 				return self.job_Info['print_stats']['print_duration']
 		return 0
 
-	def timeSinceUpdate(self):
-		if self.last_percent_update is not None:
-			return time.time() - self.last_percent_update
-		return 0
+	def update_estimate(self):
+		if self.status not in ('printing', 'paused') or not self.file_name:
+			if self.estimator.filename is not None:
+				self.estimator.reset()
+			return
+		estimator = self.estimator
+		if estimator.filename != self.file_name:
+			estimator.reset(self.file_name)
+		if estimator.estimated_time is None:
+			meta = self.file_metadata(self.file_name)
+			if meta is None:
+				self.prefetch_metadata([self.file_name])
+			else:
+				estimator.estimated_time = meta.get('estimated_time')
+		estimator.update(self.job_Info['virtual_sdcard']['progress'], self.job_Info['print_stats']['print_duration'])
 
 	def remain(self):
-		percent = self.getPercent()
-		duration = self.duration() - self.timeSinceUpdate()
-		if percent:
-			total = duration / (percent / 100)
-			return total - (duration + self.timeSinceUpdate())
-		return 0
+		# Seconds left, None while there is nothing to estimate from
+		return self.estimator.remaining
 
 	def openAndPrintFile(self, filenum):
 		self.file_name = self.files[filenum]['path']
-		self.postREST('/printer/print/start', json={'filename': self.file_name})
+		return self.postREST('/printer/print/start', json={'filename': self.file_name})
 
 	def cancel_job(self): #fixed
-		print('Canceling job:')
-		self.postREST('/printer/print/cancel', json=None)
+		logger.info("cancelling job")
+		return self.postREST('/printer/print/cancel', json=None)
 
 	def pause_job(self): #fixed
-		print('Pausing job:')
-		self.postREST('/printer/print/pause', json=None)
+		logger.info("pausing job")
+		return self.postREST('/printer/print/pause', json=None)
 
 	def resume_job(self): #fixed
-		print('Resuming job:')
-		self.postREST('/printer/print/resume', json=None)
+		logger.info("resuming job")
+		return self.postREST('/printer/print/resume', json=None)
 
 	def set_print_speed(self, fr):
 		self.print_speed = fr
@@ -687,23 +1885,59 @@ class PrinterData:
 		if axis == 'X' or axis == 'Y' or axis == 'Z' or axis == 'X Y Z':
 			GCode += axis
 		else:
-			print("home: parameter not recognised" + axis)
+			logger.warning("home: parameter not recognised %s", axis)
 			return
 
 		self.sendGCode(GCode)
 
 	def moveRelative(self, axis, distance, speed):
 		self.sendGCode('%s \n%s %s%s F%s%s' % ('G91', 'G1', axis, distance, speed,
-			'\nG90' if self.absolute_moves else ''))
+			'\nG90' if self.absolute_moves else ''), deadline=INTERACTIVE_DEADLINE)
 
 	def moveAbsolute(self, axis, position, speed):
 		self.sendGCode('%s \n%s %s%s F%s%s' % ('G90', 'G1', axis, position, speed,
 			'\nG91' if not self.absolute_moves else ''))
 
-	def sendGCode(self, gcode):
-		self.postREST('/printer/gcode/script', json={'script': gcode})
+	def sendGCode(self, gcode, deadline=None):
+		# Inside gcode_batch() the line is only collected and None returned,
+		# flush_gcode() returns the future of the combined script, sent
+		# with the deadline of the batch. deadline: seconds the script may
+		# wait in the queue, None for no limit.
+		lines = getattr(self.gcode_batch_state, 'lines', None)
+		if lines is not None:
+			lines.append(gcode)
+			future = None
+		else:
+			future = self.send_script(gcode, deadline)
 		if self.response_callback:
 			self.response_callback(gcode, 'command')
+		return future
+
+	@contextlib.contextmanager
+	def gcode_batch(self, deadline=None):
+		# Gcode sent from this thread within the block is merged, in order,
+		# into one script sent when the outermost batch ends.
+		state = self.gcode_batch_state
+		if getattr(state, 'lines', None) is None:
+			state.lines = []
+			state.depth = 0
+			state.deadline = deadline
+		state.depth += 1
+		try:
+			yield
+		finally:
+			state.depth -= 1
+			if state.depth == 0:
+				self.flush_gcode()
+				state.lines = None
+
+	def flush_gcode(self):
+		lines = getattr(self.gcode_batch_state, 'lines', None)
+		if not lines:
+			return None
+		script = '\n'.join(lines)
+		del lines[:]
+		return self.send_script(script, self.gcode_batch_state.deadline)
 
 	def disable_all_heaters(self):
 		self.setExtTemp(0)
@@ -719,7 +1953,7 @@ class PrinterData:
 			self.preHeat(self.material_preset[1].bed_temp, self.material_preset[1].hotend_temp)
 
 	def save_settings(self):
-		print('saving settings')
+		logger.info("saving settings")
 		return True
 
 	def setExtTemp(self, target, toolnum=0):
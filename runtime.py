@@ -0,0 +1,159 @@
+import asyncio
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+
+logger = log.get('runtime')
+
+# Seconds between status refreshes without a change from Klippy, the same
+# as the threaded periodic_update
+UPDATE_INTERVAL = 2.0
+# Threads for blocking work: discovery and the Moonraker status fallback
+IO_WORKERS = 2
+
+
+class Later:
+    # Handle of Runtime.call_later, cancelled from the app thread
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Runtime:
+    # One asyncio event loop, on the main thread, reads and writes the TFT
+    # serial port and the Klippy and Moonraker sockets through their fds.
+    # Everything that touches printer or LCD state (TFT commands, socket
+    # callbacks, status updates) runs on a single app thread, one after
+    # another, so that state has one writer. Blocking work goes to a small
+    # io pool. HTTP commands keep their CommandLanes.
+    def __init__(self, io_workers=IO_WORKERS, update_interval=UPDATE_INTERVAL):
+        self.loop = asyncio.new_event_loop()
+        self.app_executor = ThreadPoolExecutor(1, thread_name_prefix='app')
+        self.io_executor = ThreadPoolExecutor(io_workers, thread_name_prefix='io')
+        self.update_interval = update_interval
+        self.app = None
+        self.ready = threading.Event()
+        self.update_queued = False
+        self.fetching = False
+
+    def submit(self, fn, *args):
+        future = self.app_executor.submit(fn, *args)
+        future.add_done_callback(self.check)
+        return future
+
+    def background(self, fn, *args):
+        future = self.io_executor.submit(fn, *args)
+        future.add_done_callback(self.check)
+        return future
+
+    def fetch(self, fn, then):
+        # fn blocks on the io pool, then(result) runs on the app thread
+        def done(future):
+            if not future.cancelled() and future.exception() is None:
+                self.submit(then, future.result())
+
+        self.background(fn).add_done_callback(done)
+
+    def check(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("task failed", exc_info=future.exception())
+
+    def call_later(self, delay, fn):
+        # Thread-safe, fn runs on the app thread unless cancelled before
+        later = Later()
+
+        def fire():
+            if not later.cancelled:
+                fn()
+
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, self.submit, fire)
+        return later
+
+    # ------------- Status updates, on the app thread ----------
+    def submit_status(self, fn, *args):
+        # Socket callbacks, a changed status store queues one refresh
+        self.submit(self.status_callback, fn, args)
+
+    def status_callback(self, fn, args):
+        fn(*args)
+        if self.app is not None and self.app.ready and self.app.printer.status_event.is_set():
+            self.refresh_soon()
+
+    def refresh_soon(self):
+        if not self.update_queued:
+            self.update_queued = True
+            self.submit(self.refresh)
+
+    def refresh(self):
+        self.update_queued = False
+        if not self.app.ready:
+            return
+        printer = self.app.printer
+        printer.status_event.clear()
+        data = printer.live_status()
+        if data is None and printer.ks.connected:
+            # Polling Moonraker blocks, fetch on the io pool and apply here
+            if not self.fetching:
+                self.fetching = True
+                self.background(printer.query_status).add_done_callback(self.fetched)
+            return
+        self.app.update(data)
+
+    def fetched(self, future):
+        self.fetching = False
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            self.submit(self.app.update, future.result())
+
+    def tick(self):
+        # On the loop
+        self.submit(self.refresh_soon)
+        self.loop.call_later(self.update_interval, self.tick)
+
+    # ------------- Lifecycle ----------
+    def create(self, factory):
+        self.app = factory(self)
+        self.app.start()
+        return self.app
+
+    def started(self, future):
+        # On the loop
+        if future.cancelled() or future.exception() is not None:
+            logger.error("start failed", exc_info=None if future.cancelled() else future.exception())
+            self.loop.stop()
+            return
+        logger.info("event loop runtime started, %d threads", threading.active_count())
+        self.ready.set()
+        self.tick()
+
+    def run(self, factory, signals=True):
+        # factory(runtime) builds the application, on the app thread
+        asyncio.set_event_loop(self.loop)
+        if signals:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                self.loop.add_signal_handler(sig, self.loop.stop)
+        self.submit(self.create, factory).add_done_callback(
+            lambda future: self.loop.call_soon_threadsafe(self.started, future))
+        try:
+            self.loop.run_forever()
+        finally:
+            self.shutdown()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def shutdown(self):
+        logger.info("event loop runtime stopping")
+        self.app_executor.shutdown(wait=False, cancel_futures=True)
+        self.io_executor.shutdown(wait=False, cancel_futures=True)
+        if self.app is not None:
+            self.app.running = False
+            self.app.lcd.detach()
+            if self.app.printer.ks is not None:
+                self.app.printer.ks.klippyExit()
+            if self.app.printer.ms is not None:
+                self.app.printer.ms.klippyExit()
+        self.loop.close()
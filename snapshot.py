@@ -0,0 +1,103 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+import log
+from util import start_timer
+
+logger = log.get('snapshot')
+
+# Bumped whenever the layout of a section changes, older files are ignored
+SNAPSHOT_VERSION = 1
+# Minimum seconds between two writes, changes in between are merged
+SNAPSHOT_INTERVAL = 30.0
+# Sections older than this are not restored, the live printer state only
+# helps right after a restart
+SNAPSHOT_MAX_AGE = 7 * 24 * 3600.0
+SNAPSHOT_MAX_AGES = {'lcd': 120.0}
+
+
+class StateSnapshot:
+    # Named sections of state, written as one JSON file (tmp + rename, so a
+    # crash never leaves a torn file) and loaded again on the next start.
+    # Section values are replaced, never mutated, after update().
+    def __init__(self, filename, interval=SNAPSHOT_INTERVAL, max_ages=None, call_later=None):
+        self.filename = filename
+        self.interval = interval
+        self.max_ages = dict(SNAPSHOT_MAX_AGES, **(max_ages or {}))
+        self.call_later = call_later or start_timer
+        self.lock = threading.Lock()
+        self.key = None
+        self.sections = {}
+        self.dirty = False
+        self.timer = None
+        self.last_write = 0.0
+        self.writes = 0
+        atexit.register(self.flush)
+
+    def load(self, key):
+        # Sections written for the same key (the Moonraker address) in this
+        # format, without those past their max age
+        self.key = key
+        try:
+            with open(self.filename, 'rb') as f:
+                record = json.loads(f.read())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("ignoring unreadable snapshot %s: %s", self.filename, e)
+            return {}
+        if not isinstance(record, dict) or record.get('version') != SNAPSHOT_VERSION:
+            logger.info("ignoring snapshot of another version")
+            return {}
+        if record.get('key') != key:
+            logger.info("ignoring snapshot of %s", record.get('key'))
+            return {}
+        age = time.time() - record.get('saved', 0)
+        sections = {}
+        for name, value in record.get('sections', {}).items():
+            if 0 <= age <= self.max_ages.get(name, SNAPSHOT_MAX_AGE):
+                sections[name] = value
+        logger.info("snapshot from %.0f s ago, restoring %s", age, ", ".join(sorted(sections)) or "nothing")
+        return sections
+
+    def update(self, name, value):
+        with self.lock:
+            current = self.sections.get(name)
+            if current is value or current == value:
+                return
+            self.sections[name] = value
+            self.dirty = True
+            if self.timer is not None:
+                return
+            delay = self.last_write + self.interval - time.monotonic()
+            if delay > 0:
+                self.timer = self.call_later(delay, self.write)
+                return
+        self.write()
+
+    def write(self):
+        with self.lock:
+            self.timer = None
+            if not self.dirty:
+                return
+            data = json.dumps({'version': SNAPSHOT_VERSION, 'key': self.key, 'saved': time.time(),
+                               'sections': self.sections}, separators=(',', ':'))
+            self.dirty = False
+            self.last_write = time.monotonic()
+        tmp = self.filename + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.replace(tmp, self.filename)
+            self.writes += 1
+        except OSError as e:
+            logger.error("snapshot write failed: %s", e)
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+        self.write()
@@ -0,0 +1,179 @@
+import base64
+import binascii
+import collections
+import hashlib
+import mmap
+import os
+import re
+import threading
+
+import log
+from util import cache_path
+
+logger = log.get('thumbnail')
+
+# Not used at runtime: the i3 Mega TFT protocol has no command to transfer
+# an image. This is the extraction side for a display that can show one,
+# the slicer thumbnail embedded in a gcode file, still encoded.
+
+THUMBNAIL_SIZE = (96, 96)
+THUMBNAIL_CACHE_BYTES = 4 * 1024 * 1024
+THUMBNAIL_CACHE_ENTRIES = 512
+THUMBNAIL_MEMORY_ENTRIES = 8
+# Thumbnails are written before the first command, give up on files
+# whose comment header is larger than this
+HEADER_SCAN_LIMIT = 2 * 1024 * 1024
+
+THUMB_BEGIN = re.compile(rb';\s*thumbnail(?:_(PNG|QOI|JPG))? begin (\d+)x(\d+)')
+THUMB_END = re.compile(rb';\s*thumbnail(?:_(?:PNG|QOI|JPG))? end')
+BASE64_JUNK = re.compile(rb'[;\s]')
+
+
+def read_thumbnails(path):
+    # Returns [(format, width, height, base64 bytes)] from the gcode header.
+    # The file is mapped, only the header lines are touched.
+    thumbs = []
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return thumbs
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            limit = min(len(mm), HEADER_SCAN_LIMIT)
+            pos = 0
+            while pos < limit:
+                eol = mm.find(b'\n', pos, limit)
+                if eol < 0:
+                    eol = limit
+                line = mm[pos:eol].strip()
+                pos = eol + 1
+                if not line:
+                    continue
+                if line[:1] != b';':
+                    break  # first command, end of header
+                begin = THUMB_BEGIN.match(line)
+                if not begin:
+                    continue
+                end = THUMB_END.search(mm, pos, limit)
+                if end is None:
+                    break
+                fmt = (begin.group(1) or b'PNG').decode()
+                thumbs.append((fmt, int(begin.group(2)), int(begin.group(3)),
+                               BASE64_JUNK.sub(b'', mm[pos:end.start()])))
+                pos = end.end()
+    return thumbs
+
+
+def choose_thumbnail(thumbs, size=THUMBNAIL_SIZE):
+    # Smallest one covering the target size, otherwise the largest
+    if not thumbs:
+        return None
+    covering = [t for t in thumbs if t[1] >= size[0] and t[2] >= size[1]]
+    if covering:
+        return min(covering, key=lambda t: t[1] * t[2])
+    return max(thumbs, key=lambda t: t[1] * t[2])
+
+
+def extract(path, size=THUMBNAIL_SIZE):
+    # (format, image bytes) of the best thumbnail or None
+    thumb = choose_thumbnail(read_thumbnails(path), size)
+    if thumb is None:
+        return None
+    return thumb[0], base64.b64decode(thumb[3])
+
+
+class ThumbnailCache:
+    # Extracted thumbnails on disk keyed by path, mtime and size of the
+    # gcode file, stored as "<format>\n<image>". A hit refreshes the entry
+    # mtime, eviction drops the oldest. Files without a thumbnail are
+    # stored as empty entries.
+    def __init__(self, directory=None, size=THUMBNAIL_SIZE,
+                 max_bytes=THUMBNAIL_CACHE_BYTES, max_entries=THUMBNAIL_CACHE_ENTRIES):
+        if directory is None:
+            directory = cache_path('thumbnails')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def key(self, path, st):
+        ident = '%s\0%d\0%d\0%dx%d' % (os.path.abspath(path), st.st_mtime_ns, st.st_size, self.size[0], self.size[1])
+        return hashlib.sha1(ident.encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def get(self, path):
+        # Returns (format, image bytes) or None when the file has no thumbnail
+        path = os.path.expanduser(path)
+        st = os.stat(path)
+        key = self.key(path, st)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+        entry = os.path.join(self.directory, key + '.thumb')
+        try:
+            with open(entry, 'rb') as f:
+                data = f.read()
+            os.utime(entry)
+            hit = True
+        except FileNotFoundError:
+            try:
+                thumb = extract(path, self.size)
+            except (binascii.Error, OSError) as e:
+                logger.warning("thumbnail for %s failed: %s", path, e)
+                self.errors += 1
+                thumb = None
+            data = thumb[0].encode() + b'\n' + thumb[1] if thumb else b''
+            self.store(entry, data)
+            hit = False
+        if data:
+            fmt, image = data.split(b'\n', 1)
+            thumb = (fmt.decode(), image)
+        else:
+            thumb = None
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.memory[key] = thumb
+            while len(self.memory) > THUMBNAIL_MEMORY_ENTRIES:
+                self.memory.popitem(last=False)
+        return thumb
+
+    def store(self, entry, data):
+        tmp = entry + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, entry)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for e in it:
+                if e.name.endswith('.thumb'):
+                    st = e.stat()
+                    entries.append((st.st_mtime, st.st_size, e.path))
+                    total += st.st_size
+        if total <= self.max_bytes and len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        count = len(entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes and count <= self.max_entries:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            count -= 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'errors': self.errors}
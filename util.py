@@ -0,0 +1,19 @@
+import os
+import threading
+
+
+def cache_path(*parts):
+    # Under $XDG_CACHE_HOME/KlipperTFT (~/.cache when unset), which is created
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    directory = os.path.join(cache_home, 'KlipperTFT')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, *parts)
+
+
+def start_timer(delay, fn):
+    # Default for the call_later(delay, fn) parameters, which return a
+    # handle with cancel(): a daemon threading.Timer
+    timer = threading.Timer(delay, fn)
+    timer.daemon = True
+    timer.start()
+    return timer